@@ -7,36 +7,76 @@ https://wiki.python.org/moin/PythonDecoratorLibrary#Logging_decorator_with_speci
 
 import os
 import re
+import sys
+import hashlib
+import json
+import math
+import operator
+import sqlite3
+import atexit
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    from repr import Repr
+except ImportError:
+    from reprlib import Repr
 # import collections
+from collections import OrderedDict, namedtuple
 import functools
+import itertools
+from contextlib import contextmanager
 import logging
-from types import NoneType
-from traceback import print_exc
+import threading
+import time
+import types
+import weakref
 
-from django.core.exceptions import ImproperlyConfigured
-try:
-    # FIXME Only 1 function that requires settings: all other functions should be moved to nlp.db module?
-    from django.conf import settings
-    settings.configure()
-except ImproperlyConfigured:
-    print_exc()
-    print 'WARNING: The module named %r from file %r' % (__name__, __file__)
-    print '         can only be used within a Django project!'
-    print '         Though the module was imported, some of its functions may raise exceptions.'
-except RuntimeError:
-    print_exc()
-    print 'WARNING: Unable to configure settings (cirular import perhaps?)'
-    print '         Django settings may have already been configured elsewhere'
-
-from nlp.db import representation
-from nlp.util import force_hashable
-from inspect import getmodule
-from nlp.util import make_name
-from django.db.models.fields.related import RelatedField
+from inspect import getmodule, isgeneratorfunction
+
+# Django (and nlp, which needs it) are only imported by the functions that use them, when they are first called,
+# so importing this module for `memoize` or `log_with` doesn't load the ORM or touch the Django settings.
 
 #from exceptions import TypeError
 
 
+def _import_asyncio():
+    """The asyncio module (or trollius, its python 2.7 backport), or None, imported only when a coroutine is memoized (it's slow to import)"""
+    try:
+        import asyncio
+    except ImportError:
+        try:
+            import trollius as asyncio
+        except ImportError:
+            asyncio = None
+    return asyncio
+
+
+def _iscoroutinefunction(func):
+    """`asyncio.iscoroutinefunction` without importing asyncio: a coroutine function can't be defined before asyncio (or trollius) is imported"""
+    for name in ('asyncio', 'trollius'):
+        module = sys.modules.get(name)
+        if module is not None and module.iscoroutinefunction(func):
+            return True
+    return False
+
+
+def force_hashable(obj, recursive=True):
+    """`nlp.util.force_hashable`, which replaces this function (in this module) the first time it is called
+
+    The replacement only rebinds the module global, so a name imported with `from pug.decorators import force_hashable`
+    keeps this wrapper (and its extra call) for good. Import it from `nlp.util` instead when the call overhead matters.
+    """
+    global force_hashable
+    from nlp.util import force_hashable
+    return force_hashable(obj, recursive=recursive)
+
+
 def force_frozenset(obj):
     """Force frozenset() command to freeze the order and contents of multables and iterables like lists, dicts, generators
 
@@ -46,6 +86,250 @@ def force_frozenset(obj):
     return tuple(force_hashable(obj))
 
 
+class _KeyMark(object):
+    """Sentinel inside a cache key with a repr that is stable between processes (for persistent backends)"""
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+_KWARGS_MARK = _KeyMark('<kwargs>')
+_UNHASHABLE_MARK = _KeyMark('<unhashable>')
+
+
+def make_key(args, kwargs):
+    """Build a memoize cache key, only falling back to the slow recursive `force_hashable` when it must
+
+    When all the arguments are already hashable the key is just the args tuple (plus the kwargs, sorted by name),
+    so keyword order doesn't matter.
+
+    >>> make_key((1, 'two'), {})
+    (1, 'two')
+    >>> make_key((1,), {'b': 2, 'a': 3}) == make_key((1,), {'a': 3, 'b': 2})
+    True
+    >>> make_key(([1, [2]],), {'a': {'b': 3}})
+    (<unhashable>, ((1, (2,)),), (('a', (('b', 3),)),))
+    """
+    cache_key = args
+    if kwargs:
+        cache_key = args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+    try:
+        hash(cache_key)
+    except TypeError:
+        return (_UNHASHABLE_MARK, force_frozenset(args), force_frozenset(sorted(kwargs.items())))
+    return cache_key
+
+
+_NDARRAY_MARK = _KeyMark('<ndarray>')
+
+
+def array_digest(arr):
+    """Hashable stand-in for a NumPy array: its shape, dtype, strides and a sha1 of its raw data buffer
+
+    The buffer is hashed through a memoryview of its bytes (a uint8 view, which works for every dtype, including datetime64)
+    without copying it, unless the array isn't contiguous.
+    Arrays of python objects only hold pointers in their buffer, so they are converted with `force_hashable` instead.
+
+    >>> import numpy as np
+    >>> a = np.arange(6.).reshape(2, 3)
+    >>> array_digest(a) == array_digest(a.copy()) != array_digest(a.reshape(3, 2))
+    True
+    >>> array_digest(np.asfortranarray(a)) == array_digest(np.asfortranarray(a))
+    True
+    """
+    if arr.dtype.hasobject:
+        return (_NDARRAY_MARK, arr.shape, force_hashable(arr.tolist()))
+    data = arr
+    if not arr.flags.c_contiguous:
+        # the transpose of a Fortran-ordered array is C-contiguous, so it doesn't need to be copied either
+        data = arr.T if arr.flags.f_contiguous else arr.copy(order='C')
+    # memoryview() refuses some dtypes (datetime64, timedelta64), but any contiguous array can be viewed as bytes
+    data = data.reshape(-1).view('u1')
+    return (_NDARRAY_MARK, arr.shape, arr.dtype.str, arr.strides, hashlib.sha1(memoryview(data)).hexdigest())
+
+
+def _is_array(obj):
+    # numpy arrays are unhashable (numpy scalars are hashable and can be used in keys as-is)
+    return type(obj).__hash__ is None and hasattr(obj, '__array_interface__')
+
+
+def array_key(args, kwargs):
+    """`make_key` that replaces NumPy array arguments with their `array_digest` so they can be memoized
+
+    Use it with `@memoize(key=array_key)`. NumPy isn't imported, arrays are recognized by their `__array_interface__`.
+
+    >>> import numpy as np
+    >>> @memoize(key=array_key)
+    ... def total(arr, scale=1):
+    ...     return arr.sum() * scale
+    >>> total(np.ones((100, 100))), total(np.ones((100, 100))), total(np.ones((100, 100)), scale=2)
+    (10000.0, 10000.0, 20000.0)
+    >>> total.cache_info().hits
+    1
+    """
+    if any(_is_array(arg) for arg in args):
+        args = tuple(array_digest(arg) if _is_array(arg) else arg for arg in args)
+    if any(_is_array(value) for value in kwargs.itervalues()):
+        kwargs = dict((name, array_digest(value) if _is_array(value) else value) for name, value in kwargs.iteritems())
+    return make_key(args, kwargs)
+
+
+class _Recording(object):
+    """Items of a generator, recorded as the first consumer pulls them so that later consumers can replay them
+
+    Once `maxlen` items are recorded (or `on_append` returns False for an item), recording stops:
+    the consumer that reached the limit keeps the generator, `on_truncate` is called (so the recording is dropped from the cache),
+    and any other consumer that gets past the recorded items restarts the generator from `factory` and skips ahead.
+    """
+    def __init__(self, factory, maxlen=None, on_truncate=None, on_append=None):
+        self.factory = factory
+        self.source = factory()
+        self.items = []
+        self.done = False
+        self.truncated = False
+        self.maxlen = maxlen
+        self.on_truncate = on_truncate
+        self.on_append = on_append
+        # only one consumer at a time may pull from the source generator
+        self.lock = threading.Lock()
+
+    def truncate(self):
+        self.truncated = True
+        self.source = None
+        if self.on_truncate:
+            self.on_truncate(self)
+
+    def replay(self):
+        i, source = 0, None
+        while True:
+            if i < len(self.items):
+                yield self.items[i]
+                i += 1
+                continue
+            with self.lock:
+                if i < len(self.items):
+                    continue
+                if self.done:
+                    return
+                if self.truncated:
+                    break
+                if self.maxlen is not None and len(self.items) >= self.maxlen:
+                    source = self.source
+                    self.truncate()
+                    break
+                try:
+                    item = next(self.source)
+                except StopIteration:
+                    self.done, self.source = True, None
+                    return
+                except BaseException:
+                    self.truncate()
+                    raise
+                self.items.append(item)
+                if self.on_append is not None and not self.on_append(self, item):
+                    source = self.source
+                    self.truncate()
+            yield item
+            i += 1
+            if source is not None:
+                break
+        if source is None:
+            source = itertools.islice(self.factory(), i, None)
+        for item in source:
+            yield item
+
+
+class _Flight(object):
+    """A computation in progress that other threads can wait on to share its result or exception"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize maxbytes currbytes')
+
+
+def estimate_nbytes(obj, seen=None):
+    """Estimate the memory used by an object, including the objects it contains
+
+    NumPy arrays (and anything else with an `nbytes` attribute) count their data buffer,
+    containers and instances are measured recursively with `sys.getsizeof`, counting shared objects only once.
+
+    >>> estimate_nbytes([]) < estimate_nbytes(['a' * 1000]) < estimate_nbytes(['a' * 1000, 'b' * 1000])
+    True
+    >>> import numpy as np
+    >>> estimate_nbytes(np.zeros(1000)) >= 8000
+    True
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, (int, long)):
+        return nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, basestring):
+        return size
+    if isinstance(obj, dict):
+        size += sum(estimate_nbytes(k, seen) + estimate_nbytes(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_nbytes(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += estimate_nbytes(obj.__dict__, seen)
+    return size
+
+# every memoize (and memoize_method) instance in this process, for `memoize_stats` and `clear_all`
+_memoized = weakref.WeakSet()
+_memoized_lock = threading.Lock()
+
+
+def memoized_functions():
+    """Return a list of all the memoize instances in this process that haven't been garbage collected
+
+    Each `memoize_method` is listed once, rather than the separate cache of each of its instances.
+    """
+    with _memoized_lock:
+        return list(_memoized)
+
+
+def memoize_stats():
+    """Return the `memoize.stats()` of every memoized function, largest caches first
+
+    >>> @memoize
+    ... def triple(x):
+    ...     return 3 * x
+    >>> triple(1), triple(1)
+    (3, 3)
+    >>> [(s['entries'], s['hits'], s['misses']) for s in memoize_stats() if s['name'] == 'triple']
+    [(1, 1, 1)]
+    """
+    return sorted((m.stats() for m in memoized_functions()), key=lambda s: s['nbytes'], reverse=True)
+
+
+def dump_memoize_stats(fp=None, indent=2):
+    """Dump a JSON snapshot of `memoize_stats()` to the file `fp` (if given) and return the JSON string"""
+    snapshot = json.dumps({'time': time.time(), 'pid': os.getpid(), 'caches': memoize_stats()},
+                          indent=indent, sort_keys=True)
+    if fp is not None:
+        fp.write(snapshot)
+    return snapshot
+
+
+def clear_all():
+    """Clear the caches (and statistics) of every memoized function in this process"""
+    for memoized in memoized_functions():
+        memoized.cache_clear()
+
+
 class memoize(object):
     '''Decorator to caches a function's return value
     If called later with any set of arguments previously used,
@@ -55,41 +339,1050 @@ class memoize(object):
     https://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
 
     hobs added kwargs per http://stackoverflow.com/a/6408175/623735
+
+    Cache keys are built by `make_key`, which skips `force_hashable` whenever the arguments are already hashable.
+    Pass a different key function with `key`, e.g. `@memoize(key=array_key)` for functions of NumPy arrays.
+
+    Use `@memoize(maxsize=N)` to keep only the N most recently used results (LRU eviction).
+    Use `@memoize(maxbytes=N)` to evict least recently used results until their `estimate_nbytes` fit in N bytes.
+    Without a `maxsize` or `maxbytes` the cache is unbounded, same as the plain `@memoize`.
+
+    Use `@memoize(ttl=seconds)` to expire results that were computed more than `ttl` seconds ago.
+    Expired entries are recomputed lazily when they are next requested,
+    and all expired entries are purged every `purge_interval` seconds (default `ttl`).
+    With `stale_while_revalidate=seconds` an expired entry that is not older than that many extra seconds
+    is returned immediately while a background thread recomputes it.
+
+    Use `@memoize(single_flight=True)` when the function may be called from several threads.
+    Only the first thread to miss on a key calls the function, any other threads that miss on
+    the same key meanwhile wait for that result (or exception) instead of computing it again.
+    No lock is held while the function runs, so misses on different keys still run concurrently.
+
+    Coroutine functions (`asyncio.iscoroutinefunction`) are detected automatically, or can be forced with `coroutine=True`.
+    The memoized function then returns a future for the awaited result, and concurrent awaiters of the same key
+    share one in-flight task (each through `asyncio.shield`, so one cancelled awaiter doesn't cancel the others).
+    Only successful results are cached, and a stale entry is recomputed rather than revalidated in the background.
+
+    Generator functions are detected automatically too (or forced with `generator=True`).
+    Each call returns a new iterator, and the items are recorded lazily as the first consumer pulls them,
+    so later calls replay the recorded items and then continue pulling from the same generator.
+    At most `max_recorded` items are recorded (default unlimited), after that the recording is dropped from the cache
+    and any consumer that gets past the recorded items continues from a fresh call to the generator function.
+    With `maxbytes` the recorded items count against the budget as they are recorded, and a recording that outgrows it is dropped the same way.
+
+    >>> @memoize
+    ... def count(n):
+    ...     for i in range(n):
+    ...         print 'yielding {}'.format(i)
+    ...         yield i
+    >>> first = count(3)
+    >>> next(first)
+    yielding 0
+    0
+    >>> list(count(3))
+    yielding 1
+    yielding 2
+    [0, 1, 2]
+    >>> list(first), list(count(3))
+    ([1, 2], [0, 1, 2])
+
+    Use `@memoize(backend=SqliteCache(path))` to store results in a file shared by other processes
+    and by later runs of the same program, instead of in a dict that only lives in this process.
+    The backend does its own size-based eviction, so `maxsize` must be given to the backend rather than `memoize`.
+    TTL expiry times are still only tracked in memory, so each process recomputes an entry before trusting it.
+
+    >>> @memoize(maxsize=2)
+    ... def double(x):
+    ...     return 2 * x
+    >>> double(1), double(2), double(1), double(3)
+    (2, 4, 2, 6)
+    >>> double.cache_info()
+    CacheInfo(hits=1, misses=3, evictions=1, maxsize=2, currsize=2, maxbytes=None, currbytes=None)
+    >>> double.cache_clear()
+    >>> double.cache_info()
+    CacheInfo(hits=0, misses=0, evictions=0, maxsize=2, currsize=0, maxbytes=None, currbytes=None)
     '''
-    def __init__(self, func):
+    # whether instances are listed by `memoized_functions` (the caches of a `memoize_method` are listed through it instead)
+    registered = True
+
+    def __new__(cls, func=None, **kwargs):
+        # `@memoize(maxsize=...)` is called without the function, so return a decorator that will receive it
+        if func is None:
+            return lambda f: cls(f, **kwargs)
+        return super(memoize, cls).__new__(cls)
+
+    def __init__(self, func, maxsize=None, ttl=None, stale_while_revalidate=None, purge_interval=None,
+                 single_flight=False, backend=None, key=make_key, maxbytes=None, coroutine=None,
+                 generator=None, max_recorded=None):
+        if backend is not None and (maxsize is not None or maxbytes is not None):
+            raise ValueError('A memoize backend enforces its own limits, so pass maxsize and maxbytes to the backend instead.')
         self.func = func
-        self.cache = {}
+        self.key = key
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.bounded = maxsize is not None or maxbytes is not None
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate or 0
+        self.purge_interval = ttl if purge_interval is None else purge_interval
+        # OrderedDict keeps the least recently used entry first so it can be popped in O(1)
+        self.cache = OrderedDict() if self.bounded else {}
+        if backend is not None:
+            self.cache = backend.bind(func)
+        # time after which each cached value is stale (only populated when `ttl` is set)
+        self.expires = {}
+        # estimated size of each cached value (only populated when `maxbytes` is set)
+        self.nbytes = {}
+        self.currbytes = 0
+        self.next_purge = time.time() + (self.purge_interval or 0)
+        self.refreshing = set()
+        self.single_flight = single_flight
+        if coroutine is None:
+            coroutine = _iscoroutinefunction(func)
+        self.coroutine = coroutine
+        if generator is None:
+            generator = not coroutine and isgeneratorfunction(func)
+        if generator and backend is not None:
+            raise ValueError("Generators can't be pickled, so they can't be memoized in a persistent backend.")
+        self.generator = generator
+        self.max_recorded = max_recorded
+        # computations in progress for single_flight (or coroutine) mode, keyed by cache_key
+        self.inflight = {}
+        # guards cache mutation, which may happen in background revalidation threads
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+        # total time spent in `func` for the `computes` values it has computed (for estimating the time saved by hits)
+        self.compute_seconds, self.computes = 0., 0
+        if self.registered:
+            with _memoized_lock:
+                _memoized.add(self)
+
     def __call__(self, *args, **kwargs):
-        cache_key = (force_hashable(args), force_hashable(kwargs.items()))
-        if cache_key in self.cache:
-            return self.cache[cache_key]
+        cache_key = self.key(args, kwargs)
+        if self.coroutine:
+            return self._call_async(cache_key, args, kwargs)
+        if self.generator:
+            return self._call_generator(cache_key, args, kwargs)
+        if self.ttl is not None:
+            now = time.time()
+            if now >= self.next_purge:
+                self.purge(now)
+        try:
+            value = self.cache[cache_key]
+        except KeyError:
+            return self._miss(cache_key, args, kwargs)
+        if self.ttl is not None:
+            stale_since = self.expires.get(cache_key, 0)
+            if now >= stale_since:
+                if now >= stale_since + self.stale_while_revalidate:
+                    return self._miss(cache_key, args, kwargs)
+                self._revalidate(cache_key, args, kwargs)
+        self.hits += 1
+        if self.bounded:
+            self._touch(cache_key)
+        return value
+
+    def _touch(self, cache_key):
+        """Make `cache_key` the most recently used entry"""
+        # python 2.7 OrderedDict has no move_to_end(), but pop + set is still O(1)
+        with self.lock:
+            if cache_key in self.cache:
+                self.cache[cache_key] = self.cache.pop(cache_key)
+
+    def _miss(self, cache_key, args, kwargs):
+        self.misses += 1
+        if not self.single_flight:
+            value = self._compute(args, kwargs)
+            self._store(cache_key, value)
+            return value
+        with self.lock:
+            # a leader may have stored the value and finished its flight after this thread missed
+            if cache_key in self.cache and (self.ttl is None or time.time() < self.expires.get(cache_key, 0)):
+                return self.cache[cache_key]
+            flight = self.inflight.get(cache_key)
+            if flight is None:
+                flight = self.inflight[cache_key] = _Flight()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            return flight.wait()
+        try:
+            flight.value = self._compute(args, kwargs)
+            self._store(cache_key, flight.value)
+        except BaseException:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[cache_key]
+            flight.done.set()
+        return flight.value
+
+    def _compute(self, args, kwargs, count=1):
+        """Call the function and keep track of how long it takes"""
+        start = time.time()
+        value = self.func(*args, **kwargs)
+        self.compute_seconds += time.time() - start
+        self.computes += count
+        return value
+
+    def _call_async(self, cache_key, args, kwargs):
+        """Return a future for the cached result of a coroutine function, sharing the task of any call in progress"""
+        asyncio = _import_asyncio()
+        if self.ttl is not None and time.time() >= self.next_purge:
+            self.purge()
+        try:
+            value = self.cache[cache_key]
+        except KeyError:
+            pass
         else:
-            value = self.func(*args, **kwargs)
+            if self.ttl is None or time.time() < self.expires.get(cache_key, 0):
+                self.hits += 1
+                if self.bounded:
+                    self._touch(cache_key)
+                future = asyncio.Future()
+                future.set_result(value)
+                return future
+        task = self.inflight.get(cache_key)
+        if task is None:
+            self.misses += 1
+            task = self.inflight[cache_key] = asyncio.ensure_future(self.func(*args, **kwargs))
+            task.add_done_callback(functools.partial(self._finish_async, cache_key))
+        return asyncio.shield(task)
+
+    def _finish_async(self, cache_key, task):
+        self.inflight.pop(cache_key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._store(cache_key, task.result())
+
+    def _call_generator(self, cache_key, args, kwargs):
+        """Return an iterator that replays (and continues) the recorded items of a generator function"""
+        if self.ttl is not None and time.time() >= self.next_purge:
+            self.purge()
+        with self.lock:
+            recording = self.cache.get(cache_key)
+            if recording is not None and (self.ttl is None or time.time() < self.expires.get(cache_key, 0)):
+                self.hits += 1
+                if self.bounded:
+                    self._touch(cache_key)
+            else:
+                self.misses += 1
+                recording = _Recording(functools.partial(self.func, *args, **kwargs), maxlen=self.max_recorded,
+                                       on_truncate=functools.partial(self._drop_recording, cache_key),
+                                       on_append=None if self.maxbytes is None else functools.partial(self._grow_recording, cache_key))
+                self._store(cache_key, recording)
+        return recording.replay()
+
+    def _grow_recording(self, cache_key, recording, item):
+        """Add the size of a newly recorded item to the `maxbytes` budget, return False if the recording no longer fits"""
+        nbytes = estimate_nbytes(item)
+        with self.lock:
+            if self.cache.get(cache_key) is not recording:
+                # evicted (or never stored), so there's no reason to keep recording it
+                return False
+            total = self.nbytes[cache_key] + nbytes
+            if total > self.maxbytes:
+                return False
+            self.nbytes[cache_key] = total
+            self.currbytes += nbytes
+            while self.currbytes > self.maxbytes:
+                self._discard(next(key for key in self.cache if key != cache_key))
+                self.evictions += 1
+        return True
+
+    def _drop_recording(self, cache_key, recording):
+        with self.lock:
+            if self.cache.get(cache_key) is recording:
+                self._discard(cache_key)
+
+    def _store(self, cache_key, value):
+        if self.maxbytes is not None:
+            nbytes = estimate_nbytes(value)
+            if nbytes > self.maxbytes:
+                # it would evict everything else and then itself
+                return
+        with self.lock:
+            if self.bounded:
+                self._discard(cache_key)
             self.cache[cache_key] = value
-            return value
+            if self.ttl is not None:
+                self.expires[cache_key] = time.time() + self.ttl
+            if self.maxbytes is not None:
+                self.nbytes[cache_key] = nbytes
+                self.currbytes += nbytes
+            if self.bounded:
+                while ((self.maxsize is not None and len(self.cache) > self.maxsize) or
+                       (self.maxbytes is not None and self.currbytes > self.maxbytes)):
+                    self._discard(next(iter(self.cache)))
+                    self.evictions += 1
+
+    def _discard(self, cache_key):
+        """Delete an entry and its bookkeeping, if it is in the cache"""
+        with self.lock:
+            self.cache.pop(cache_key, None)
+            self.expires.pop(cache_key, None)
+            self.currbytes -= self.nbytes.pop(cache_key, 0)
+
+    def _revalidate(self, cache_key, args, kwargs):
+        """Recompute a stale value in a background thread, unless it is already being recomputed"""
+        with self.lock:
+            if cache_key in self.refreshing:
+                return
+            self.refreshing.add(cache_key)
+        thread = threading.Thread(target=self._refresh, args=(cache_key, args, kwargs))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, cache_key, args, kwargs):
+        try:
+            self._store(cache_key, self._compute(args, kwargs))
+        except Exception:
+            # keep serving the stale value, the next request after it expires will try again
+            log.exception('Unable to revalidate the memoized value for {}'.format(getattr(self.func, '__name__', self.func)))
+        finally:
+            with self.lock:
+                self.refreshing.discard(cache_key)
+
+    def purge(self, now=None):
+        """Delete all entries that are too old to be returned, even as stale values"""
+        now = time.time() if now is None else now
+        with self.lock:
+            oldest = now - self.stale_while_revalidate
+            for cache_key, stale_since in list(self.expires.items()):
+                if stale_since <= oldest:
+                    self._discard(cache_key)
+            self.next_purge = now + (self.purge_interval or 0)
+
+    def cache_info(self):
+        """Return a namedtuple of cache statistics (hits, misses, evictions, maxsize, currsize, maxbytes, currbytes)
+
+        `currbytes` is only tracked (and not None) when there is a `maxbytes` budget.
+        """
+        if self.backend is None:
+            maxsize, maxbytes = self.maxsize, self.maxbytes
+        else:
+            maxsize, maxbytes = self.backend.maxsize, self.backend.maxbytes
+        return CacheInfo(self.hits, self.misses, self.evictions, maxsize, len(self.cache),
+                         maxbytes, None if self.maxbytes is None else self.currbytes)
+
+    def cache_clear(self):
+        """Delete all cached values and reset the statistics"""
+        with self.lock:
+            self.cache.clear()
+            self.expires.clear()
+            self.nbytes.clear()
+            self.currbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.compute_seconds, self.computes = 0., 0
+
+    def stats(self):
+        """Return a dict of statistics about this cache for the `memoize_stats` registry snapshot
+
+        `nbytes` is the tracked size when there is a `maxbytes` budget, otherwise it is estimated (which may take a while).
+        """
+        info = self.cache_info()
+        if info.currbytes is not None:
+            nbytes = info.currbytes
+        elif self.backend is not None:
+            nbytes = self.cache.nbytes()
+        else:
+            with self.lock:
+                values = list(self.cache.values())
+            nbytes = estimate_nbytes(values) - estimate_nbytes([None] * len(values))
+        mean_compute_seconds = self.compute_seconds / self.computes if self.computes else None
+        return {
+            'name': getattr(self.func, '__name__', repr(self.func)),
+            'module': getattr(self.func, '__module__', None),
+            'entries': info.currsize,
+            'nbytes': nbytes,
+            'hits': info.hits,
+            'misses': info.misses,
+            'evictions': info.evictions,
+            'mean_compute_seconds': mean_compute_seconds,
+            'seconds_saved': None if mean_compute_seconds is None else info.hits * mean_compute_seconds,
+            }
+
     def __repr__(self):
         '''Return the function's docstring.'''
         return self.func.__doc__
+
     def __get__(self, obj, objtype):
-        '''Support instance methods.'''
+        '''Support instance methods.
+
+        All instances share one cache (keyed on `self`) that keeps them alive, see `memoize_method` to avoid that.
+        '''
         return functools.partial(self.__call__, obj)
 
 
+class memoize_method(object):
+    '''Decorator to memoize a method with a separate cache for each instance
+
+    The first time the method is looked up on an instance, a `memoize` of that method is stored in the instance `__dict__`
+    (under a private name), so later lookups find it there without allocating anything.
+    Copies of the instance (`copy.copy`, `copy.deepcopy`, `pickle`) don't take the cache along, they start their own.
+    The cache only holds a weak reference to its instance, so it is freed along with the instance.
+    Instances without a `__dict__` (`__slots__`) get their caches from a `weakref.WeakKeyDictionary` instead.
+    Any keyword arguments (`maxsize`, `ttl`, etc) are passed along to each instance's `memoize`.
+    The method itself (`Class.method`) has `cache_info`, `cache_clear` and `stats` that add up the caches of all of its instances,
+    and it is listed once by `memoized_functions` and `memoize_stats`, however many instances there are.
+
+    >>> class Doubler(object):
+    ...     def __init__(self, factor):
+    ...         self.factor = factor
+    ...     @memoize_method(maxsize=100)
+    ...     def double(self, x):
+    ...         return self.factor * 2 * x
+    >>> a, b = Doubler(1), Doubler(10)
+    >>> a.double(1), b.double(1), a.double(1)
+    (2, 20, 2)
+    >>> a.double.cache_info()
+    CacheInfo(hits=1, misses=1, evictions=0, maxsize=100, currsize=1, maxbytes=None, currbytes=None)
+    >>> a.double is a.double
+    True
+    >>> Doubler.double.cache_info()
+    CacheInfo(hits=1, misses=2, evictions=0, maxsize=100, currsize=2, maxbytes=None, currbytes=None)
+    '''
+    def __new__(cls, func=None, **kwargs):
+        if func is None:
+            return lambda f: cls(f, **kwargs)
+        return super(memoize_method, cls).__new__(cls)
+
+    def __init__(self, func, **kwargs):
+        if kwargs.get('backend') is not None:
+            raise ValueError("Per-instance method caches can't share a persistent memoize backend.")
+        self.func = func
+        self.kwargs = kwargs
+        self.__doc__ = func.__doc__
+        # private to this descriptor, so the cache isn't confused with an attribute (or another memoize_method) of the same name
+        self.attr = '_memoize_method_{}_{}'.format(func.__name__, id(self))
+        self.instance_caches = weakref.WeakKeyDictionary()
+        # the caches of all the live instances, for the aggregate statistics
+        self.bound_caches = weakref.WeakSet()
+        self.lock = threading.Lock()
+        with _memoized_lock:
+            _memoized.add(self)
+
+    def bind(self, obj):
+        """Return a new memoize of this method bound to `obj` without keeping `obj` alive"""
+        func, ref = self.func, weakref.ref(obj)
+
+        def method(*args, **kwargs):
+            return func(ref(), *args, **kwargs)
+        functools.update_wrapper(method, func)
+        kwargs = dict(self.kwargs)
+        if kwargs.get('coroutine') is None:
+            # the wrapper isn't a coroutine (or generator) function itself, even when it returns one
+            kwargs['coroutine'] = _iscoroutinefunction(func)
+        if kwargs.get('generator') is None:
+            kwargs['generator'] = not kwargs['coroutine'] and isgeneratorfunction(func)
+        bound = _instance_memoize(method, **kwargs)
+        bound.instance = ref
+        with self.lock:
+            self.bound_caches.add(bound)
+        return bound
+
+    def caches(self):
+        """Return a list of the `memoize` caches of the instances that haven't been garbage collected"""
+        with self.lock:
+            return list(self.bound_caches)
+
+    def cache_info(self):
+        """Return the `CacheInfo` totals of the caches of all the instances"""
+        infos = [cache.cache_info() for cache in self.caches()]
+        maxbytes = self.kwargs.get('maxbytes')
+        return CacheInfo(sum(info.hits for info in infos), sum(info.misses for info in infos),
+                         sum(info.evictions for info in infos), self.kwargs.get('maxsize'),
+                         sum(info.currsize for info in infos), maxbytes,
+                         None if maxbytes is None else sum(info.currbytes for info in infos))
+
+    def cache_clear(self):
+        """Clear the cache (and statistics) of every instance"""
+        for cache in self.caches():
+            cache.cache_clear()
+
+    def stats(self):
+        """Return `memoize.stats()` totals of the caches of all the instances (counted in `instances`)"""
+        caches = self.caches()
+        rows = [cache.stats() for cache in caches]
+        compute_seconds, computes = sum(cache.compute_seconds for cache in caches), sum(cache.computes for cache in caches)
+        mean_compute_seconds = compute_seconds / computes if computes else None
+        hits = sum(row['hits'] for row in rows)
+        return {
+            'name': getattr(self.func, '__name__', repr(self.func)),
+            'module': getattr(self.func, '__module__', None),
+            'instances': len(rows),
+            'entries': sum(row['entries'] for row in rows),
+            'nbytes': sum(row['nbytes'] for row in rows),
+            'hits': hits,
+            'misses': sum(row['misses'] for row in rows),
+            'evictions': sum(row['evictions'] for row in rows),
+            'mean_compute_seconds': mean_compute_seconds,
+            'seconds_saved': None if mean_compute_seconds is None else hits * mean_compute_seconds,
+            }
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            instance_dict = obj.__dict__
+        except AttributeError:
+            try:
+                return self.instance_caches[obj]
+            except KeyError:
+                bound = self.instance_caches[obj] = self.bind(obj)
+                return bound
+        bound = instance_dict.get(self.attr)
+        # a copy of the instance gets a reference to the original's cache in its __dict__, so it needs its own
+        if bound is None or bound.instance() is not obj:
+            bound = instance_dict[self.attr] = self.bind(obj)
+        return bound
+
+
+def _no_cache():
+    return None
+
+
+class _instance_memoize(memoize):
+    """The `memoize` of a `memoize_method` for one instance, which is left behind when the instance is copied or pickled"""
+    registered = False
+
+    def __reduce_ex__(self, protocol):
+        return (_no_cache, ())
+
+
+class memoize_batch(memoize):
+    '''Decorator to memoize a vectorized function item by item, only computing the items that missed
+
+    The wrapped function must take a sequence (list, tuple or NumPy array) of items as its first argument
+    and return a sequence with one result per item, in the same order.
+    Each item is cached separately (keyed on the item and the remaining arguments),
+    and the function is called once per batch with just the items that aren't in the cache yet (without duplicates).
+    The results are returned as a list in the original order, or passed to `collate` (e.g. `numpy.array`) if given.
+    `maxsize`, `ttl`, `backend` and `key` work the same as for `memoize`.
+
+    >>> @memoize_batch
+    ... def lengths(words):
+    ...     print 'computing {}'.format(words)
+    ...     return [len(w) for w in words]
+    >>> lengths(['one', 'three', 'one'])
+    computing ['one', 'three']
+    [3, 5, 3]
+    >>> lengths(['three', 'four'])
+    computing ['four']
+    [5, 4]
+    >>> lengths.cache_info()
+    CacheInfo(hits=1, misses=3, evictions=0, maxsize=None, currsize=3, maxbytes=None, currbytes=None)
+    '''
+    def __new__(cls, func=None, **kwargs):
+        if func is None:
+            return lambda f: cls(f, **kwargs)
+        return super(memoize, cls).__new__(cls)
+
+    def __init__(self, func, collate=None, **kwargs):
+        if kwargs.get('single_flight') or kwargs.get('stale_while_revalidate'):
+            raise ValueError('memoize_batch does not support single_flight or stale_while_revalidate.')
+        super(memoize_batch, self).__init__(func, **kwargs)
+        self.collate = collate
+
+    def __call__(self, items, *args, **kwargs):
+        if not hasattr(items, '__getitem__'):
+            items = list(items)
+        if self.ttl is not None:
+            now = time.time()
+            if now >= self.next_purge:
+                self.purge(now)
+        results = [None] * len(items)
+        # positions of each missing item in `items`, in order of first appearance
+        missing = OrderedDict()
+        for i, item in enumerate(items):
+            cache_key = self.key((item,) + args, kwargs)
+            if cache_key in missing:
+                missing[cache_key].append(i)
+                continue
+            try:
+                results[i] = self.cache[cache_key]
+            except KeyError:
+                missing[cache_key] = [i]
+                continue
+            if self.ttl is not None and now >= self.expires.get(cache_key, 0):
+                missing[cache_key] = [i]
+                continue
+            self.hits += 1
+            if self.bounded:
+                self._touch(cache_key)
+        if missing:
+            self.misses += len(missing)
+            first_positions = [positions[0] for positions in missing.itervalues()]
+            if _is_array(items):
+                batch = items[first_positions]
+            else:
+                batch = [items[i] for i in first_positions]
+            computed = self._compute((batch,) + args, kwargs, count=len(batch))
+            if len(computed) != len(batch):
+                raise ValueError('{} returned {} results for a batch of {} items.'.format(
+                    getattr(self.func, '__name__', self.func), len(computed), len(batch)))
+            for (cache_key, positions), value in zip(missing.iteritems(), computed):
+                self._store(cache_key, value)
+                for i in positions:
+                    results[i] = value
+        return results if self.collate is None else self.collate(results)
+
+
+def function_version(func, salt=''):
+    """Hash of a function's bytecode and constants that changes whenever the function's code is edited
+
+    >>> def f(x): return x + 1
+    >>> def g(x): return x + 1
+    >>> def h(x): return x + 2
+    >>> function_version(f) == function_version(g) != function_version(h)
+    True
+    >>> function_version(f) == function_version(f, salt='v2')
+    False
+    """
+    digest = hashlib.sha1(str(salt))
+
+    def update(code):
+        digest.update(code.co_code)
+        for const in code.co_consts:
+            # nested functions and lambdas have code objects whose repr includes a memory address
+            if hasattr(const, 'co_code'):
+                update(const)
+            else:
+                digest.update(repr(const))
+    update(getattr(func, '__code__', getattr(func, 'func_code', None)) or getattr(func.__call__, '__code__'))
+    return digest.hexdigest()
+
+
+def stable_key(obj):
+    """A canonical form of a cache key, for pickling it the same way in every process
+
+    Sets are sorted (by their pickled items) and lists become tuples.
+    Raises TypeError for objects that only have an identity (the default `repr`), which equal keys can't be built from.
+
+    >>> stable_key((1, frozenset(['b', 'a']), [2.0]))
+    (1, ('<set>', 'a', 'b'), (2.0,))
+    >>> stable_key((object(),))
+    Traceback (most recent call last):
+      ...
+    TypeError: object has no stable key (it has the default repr)
+    """
+    if isinstance(obj, (tuple, list)):
+        return tuple(stable_key(item) for item in obj)
+    if isinstance(obj, (set, frozenset)):
+        return ('<set>',) + tuple(sorted((stable_key(item) for item in obj), key=lambda item: pickle.dumps(item, 2)))
+    cls = type(obj)
+    if cls.__repr__ is object.__repr__ or (cls is types.InstanceType and not hasattr(obj, '__repr__')):
+        raise TypeError('{} has no stable key (it has the default repr)'.format(getattr(obj.__class__, '__name__', cls.__name__)))
+    return obj
+
+
+@contextmanager
+def _immediate_transaction(connection):
+    """Write transaction on an autocommit sqlite3 connection that locks the database as soon as it begins"""
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+class SqliteCache(object):
+    """Persistent memoize backend that stores pickled results in a SQLite file
+
+    Several processes (cron jobs, gunicorn workers) can share one file, and it survives restarts.
+    Writers take an immediate transaction in WAL mode, so concurrent processes wait rather than corrupt the file.
+    Entries are keyed by the function's module, name and `function_version` along with
+    a sha1 of the pickled cache key (with sets in a canonical order, see `stable_key`).
+    Keys that include an object that only has an identity (a default `repr`, like `<Box object at 0x...>`),
+    or that can't be pickled, bypass the file: those calls are computed every time rather than risk a collision.
+    Reading an entry only updates its access time (for LRU eviction) if it's older than `touch_interval` seconds,
+    so cache hits don't all have to take the database write lock.
+    Editing the function (or changing `salt`) starts a new namespace, and the stale entries age out through eviction.
+    `maxsize` (entries) and `maxbytes` (pickled bytes) limit the whole file by evicting the least recently used entries.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'memoize.sqlite')
+    >>> @memoize(backend=SqliteCache(path, maxsize=2))
+    ... def double(x):
+    ...     return 2 * x
+    >>> double(1), double(2), double(3)
+    (2, 4, 6)
+    >>> len(double.cache)
+    2
+    >>> restarted = memoize(double.func, backend=SqliteCache(path))
+    >>> restarted(3), restarted.cache_info().hits
+    (6, 1)
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS memoize (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+        'size INTEGER NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (namespace, key))',
+        'CREATE INDEX IF NOT EXISTS memoize_accessed ON memoize (accessed)',
+        # running totals maintained by triggers, so eviction doesn't need a full table scan to count entries
+        'CREATE TABLE IF NOT EXISTS memoize_totals (entries INTEGER NOT NULL, bytes INTEGER NOT NULL)',
+        'INSERT INTO memoize_totals SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM memoize_totals)',
+        'CREATE TRIGGER IF NOT EXISTS memoize_insert AFTER INSERT ON memoize BEGIN '
+        'UPDATE memoize_totals SET entries = entries + 1, bytes = bytes + NEW.size; END',
+        'CREATE TRIGGER IF NOT EXISTS memoize_delete AFTER DELETE ON memoize BEGIN '
+        'UPDATE memoize_totals SET entries = entries - 1, bytes = bytes - OLD.size; END',
+        )
+
+    def __init__(self, path, maxsize=None, maxbytes=None, salt='', namespace='', timeout=30., touch_interval=60.):
+        self.path = path
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.salt = salt
+        self.namespace = namespace
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.local = threading.local()
+
+    def bind(self, func):
+        """Return a copy of this backend that stores the results of `func` in their own namespace"""
+        namespace = '{}.{}:{}'.format(getattr(func, '__module__', ''), getattr(func, '__name__', repr(func)),
+                                      function_version(func, salt=self.salt))
+        return self.__class__(self.path, maxsize=self.maxsize, maxbytes=self.maxbytes, salt=self.salt,
+                              namespace=namespace, timeout=self.timeout, touch_interval=self.touch_interval)
+
+    @property
+    def connection(self):
+        """A connection for the current thread and process (sqlite3 connections can't be shared by either)"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # so INSERT OR REPLACE fires the delete trigger and keeps the totals right
+            connection.execute('PRAGMA recursive_triggers=ON')
+            with _immediate_transaction(connection):
+                for sql in self.SCHEMA:
+                    connection.execute(sql)
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    @staticmethod
+    def serialize_key(cache_key):
+        """The sha1 of the pickled `stable_key` of `cache_key`, or None if it can't be serialized stably"""
+        try:
+            return hashlib.sha1(pickle.dumps(stable_key(cache_key), 2)).hexdigest()
+        except (TypeError, pickle.PicklingError, AttributeError):
+            return None
+
+    def __getitem__(self, cache_key):
+        key = self.serialize_key(cache_key)
+        if key is None:
+            raise KeyError(cache_key)
+        connection = self.connection
+        row = connection.execute('SELECT value, accessed FROM memoize WHERE namespace = ? AND key = ?',
+                                 (self.namespace, key)).fetchone()
+        if row is None:
+            raise KeyError(cache_key)
+        now = time.time()
+        if now - row[1] >= self.touch_interval:
+            # a single statement is atomic in autocommit mode, and a missed update only makes eviction less precise
+            try:
+                connection.execute('UPDATE memoize SET accessed = ? WHERE namespace = ? AND key = ?', (now, self.namespace, key))
+            except sqlite3.OperationalError:
+                pass
+        return pickle.loads(str(row[0]))
+
+    def __setitem__(self, cache_key, value):
+        key = self.serialize_key(cache_key)
+        if key is None:
+            return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        connection = self.connection
+        with _immediate_transaction(connection):
+            connection.execute('INSERT OR REPLACE INTO memoize (namespace, key, value, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                               (self.namespace, key, sqlite3.Binary(pickled), len(pickled), time.time()))
+            self.evict(connection)
+
+    def evict(self, connection):
+        """Delete the least recently used entries until the file is within `maxsize` and `maxbytes`"""
+        while True:
+            entries, nbytes = connection.execute('SELECT entries, bytes FROM memoize_totals').fetchone()
+            excess = 0
+            if self.maxsize is not None and entries > self.maxsize:
+                excess = entries - self.maxsize
+            if self.maxbytes is not None and nbytes > self.maxbytes and entries:
+                excess = max(excess, 1)
+            if not excess:
+                return
+            connection.execute('DELETE FROM memoize WHERE rowid IN (SELECT rowid FROM memoize ORDER BY accessed LIMIT ?)', (excess,))
+
+    def __contains__(self, cache_key):
+        key = self.serialize_key(cache_key)
+        return key is not None and self.connection.execute('SELECT 1 FROM memoize WHERE namespace = ? AND key = ?',
+                                                           (self.namespace, key)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM memoize WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+
+    def nbytes(self):
+        """Total size of the pickled values in this namespace"""
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM memoize WHERE namespace = ?',
+                                       (self.namespace,)).fetchone()[0]
+
+    def pop(self, cache_key, *default):
+        try:
+            value = self[cache_key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        connection = self.connection
+        with _immediate_transaction(connection):
+            connection.execute('DELETE FROM memoize WHERE namespace = ? AND key = ?', (self.namespace, self.serialize_key(cache_key)))
+        return value
+
+    def clear(self):
+        connection = self.connection
+        with _immediate_transaction(connection):
+            connection.execute('DELETE FROM memoize WHERE namespace = ?', (self.namespace,))
+
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
+class LatencyHistogram(object):
+    """Log-scale histogram of durations (in seconds) with approximate percentiles
+
+    Buckets grow by a factor of `ratio` from `min_seconds` up, so percentiles are accurate to about `ratio - 1` (19%)
+    and recording a duration is O(1) no matter how many have been recorded.
+
+    >>> h = LatencyHistogram()
+    >>> for ms in range(1, 101):
+    ...     h.record(ms / 1000.)
+    >>> 0.049 < h.percentile(50) < 0.06, 0.09 < h.percentile(99) <= 0.1
+    (True, True)
+    >>> sorted(h.summary())
+    ['count', 'max', 'mean', 'p50', 'p95', 'p99']
+    """
+    def __init__(self, min_seconds=1e-6, ratio=2 ** 0.25, nbuckets=128):
+        self.min_seconds = min_seconds
+        self.ratio = ratio
+        self.log_ratio = math.log(ratio)
+        self.counts = [0] * nbuckets
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        if seconds > self.min_seconds:
+            i = min(int(math.log(seconds / self.min_seconds) / self.log_ratio) + 1, len(self.counts) - 1)
+        else:
+            i = 0
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent):
+        """Upper bound of the bucket containing the `percent` percentile (clipped to the largest duration recorded)"""
+        if not self.count:
+            return None
+        rank = percent / 100. * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(self.min_seconds * self.ratio ** i, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            }
+
+
+# wall and CPU time histograms of the functions decorated with `log_with(timing=True)`, keyed by module.name
+latency_histograms = {}
+# time.clock() is process CPU time on Linux/Mac in python 2, time.process_time() replaces it in python 3
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def latency_summary():
+    """Return the p50/p95/p99 summary of the wall and CPU time of every function timed by `log_with(timing=True)`"""
+    return dict((name, dict((kind, histogram.summary()) for kind, histogram in histograms.iteritems()))
+                for name, histograms in latency_histograms.items())
+
+
+class QueueLogHandler(logging.Handler):
+    """Logging handler that puts records on a bounded queue instead of writing them, for a `QueueLogListener` to emit
+
+    Messages are formatted (merged with their args) before they are queued, so later changes to the args don't matter.
+    When the queue is full, `overflow='drop'` discards the record (and counts it in `dropped`),
+    while `overflow='block'` waits for room.
+    """
+    def __init__(self, queue, overflow='drop'):
+        if overflow not in ('drop', 'block'):
+            raise ValueError("overflow must be 'drop' or 'block', not {!r}".format(overflow))
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if self.overflow == 'block':
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueLogListener(object):
+    """Background thread that takes log records off a queue and passes them to the handlers that do the slow I/O
+
+    If the `handlers` were moved from a `logger` (by `queue_log_handlers`), stopping the listener puts them back,
+    replacing its `queue_handler`, so records logged after it stops are emitted directly rather than queued for nobody.
+    """
+    _STOP = object()
+
+    def __init__(self, queue, handlers, logger=None, queue_handler=None):
+        self.queue = queue
+        self.handlers = list(handlers)
+        self.logger = logger
+        self.queue_handler = queue_handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.drain, name='QueueLogListener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Restore the logger's handlers, emit all the records already queued, then stop the thread and flush the handlers"""
+        if self.thread is None:
+            return
+        if self.logger is not None:
+            for handler in self.handlers:
+                self.logger.addHandler(handler)
+            self.logger.removeHandler(self.queue_handler)
+        self.queue.put(self._STOP)
+        self.thread.join()
+        self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def _handling_logger(logger):
+    """The logger whose handlers will actually emit the records logged to `logger` (it or its nearest ancestor)"""
+    while logger is not None and not logger.handlers and logger.propagate:
+        logger = logger.parent
+    return logger or logging.getLogger()
+
+
+def queue_log_handlers(logger=None, maxsize=10000, overflow='drop'):
+    """Move the handlers of a logger to a background thread, so logging never waits on their I/O
+
+    The handlers are replaced with a `QueueLogHandler` feeding a queue of at most `maxsize` records,
+    which a `QueueLogListener` thread drains into the original handlers.
+    The listener is stopped at exit, after it has emitted every queued record.
+    Stopping it (`handler.listener.stop()`) gives the logger back its original handlers.
+    Returns the `QueueLogHandler` (with a `listener` attribute). Calling it again for the same logger returns the same one.
+    A logger without handlers (e.g. the root logger before logging is configured) is left alone and None is returned,
+    since its records would be queued for nobody, and `logging.basicConfig()` would no longer add a handler to the root logger.
+
+    >>> import StringIO
+    >>> stream = StringIO.StringIO()
+    >>> logger = logging.getLogger('pug.decorators.queue_log_handlers')
+    >>> logger.propagate = False
+    >>> logger.addHandler(logging.StreamHandler(stream))
+    >>> handler = queue_log_handlers(logger, maxsize=100)
+    >>> logger.handlers == [handler]
+    True
+    >>> logger.warn('queued %s', 'message')
+    >>> handler.listener.stop()
+    >>> stream.getvalue()
+    'queued message\\n'
+    >>> handler in logger.handlers
+    False
+    """
+    if logger is None or isinstance(logger, basestring):
+        logger = logging.getLogger(logger)
+    for handler in logger.handlers:
+        if isinstance(handler, QueueLogHandler):
+            return handler
+    handlers = list(logger.handlers)
+    if not handlers:
+        return None
+    listener = QueueLogListener(queue.Queue(maxsize), handlers, logger=logger)
+    handler = listener.queue_handler = QueueLogHandler(listener.queue, overflow=overflow)
+    handler.listener = listener
+    for original in handlers:
+        logger.removeHandler(original)
+    logger.addHandler(handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+
 class log_with(object):
     '''Logging decorator that allows you to specify a specific logger.
 
     https://wiki.python.org/moin/PythonDecoratorLibrary#Logging_decorator_with_specified_logger_.28or_default.29
+
+    Messages are only formatted when the logger is enabled for the `level` they'd be logged at.
+
+    With `timing=True` nothing is logged for each call. Instead the wall and CPU time of every call are recorded
+    in the `LatencyHistogram`s of `latency_histograms` (also attached to the wrapper as `.latency`),
+    and `latency_summary()` (or the wrapper's `.latency_summary()`) reports their percentiles.
+    Each wrapper has its own histograms, named `module.function` (the wrapper's `.latency_name`),
+    with a `#2`, `#3`, ... suffix for other functions of the same name, like methods of different classes.
+
+    With `queued=True` the handlers that emit the logger's records are moved to a background thread
+    with `queue_log_handlers`, so the wrapped function doesn't wait on their disk or network writes.
+    Nothing is queued if there are no handlers yet when the function is decorated.
+
+    >>> @log_with(timing=True)
+    ... def nap(seconds):
+    ...     time.sleep(seconds)
+    >>> for i in range(10):
+    ...     nap(.001)
+    >>> summary = nap.latency_summary()
+    >>> summary['wall']['count'], summary['wall']['p50'] >= 0.0008, summary['cpu']['p50'] < 0.0008
+    (10, True, True)
     '''
     # Customize these messages
     ENTRY_MESSAGE = 'Entering {}'
     EXIT_MESSAGE = 'Exiting {}'
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, timing=False, level=logging.INFO, queued=False):
         self.logger = logger
+        self.timing = timing
+        self.level = level
+        self.queued = queued
 
     def __call__(self, func):
         '''Returns a wrapper that wraps func.
@@ -101,15 +1394,186 @@ class log_with(object):
         if not self.logger:
             logging.basicConfig()
             self.logger = logging.getLogger(func.__module__)
+        if self.queued:
+            queue_log_handlers(_handling_logger(self.logger))
+
+        if self.timing:
+            return self.timed(func)
 
         @functools.wraps(func)
         def wrapper(*args, **kwds):
-            self.logger.info(self.ENTRY_MESSAGE.format(func.__name__))  # logging level .info(). Set to .debug() if you want to
+            # skip the string formatting entirely when the logger would drop the message
+            enabled = self.logger.isEnabledFor(self.level)
+            if enabled:
+                self.logger.log(self.level, self.ENTRY_MESSAGE.format(func.__name__))
             f_result = func(*args, **kwds)
-            self.logger.info(self.EXIT_MESSAGE.format(func.__name__))   # logging level .info(). Set to .debug() if you want to
+            if enabled:
+                self.logger.log(self.level, self.EXIT_MESSAGE.format(func.__name__))
             return f_result
         return wrapper
 
+    def timed(self, func):
+        '''Returns a wrapper that records the wall and CPU time of each call to func in latency histograms'''
+        histograms = {'wall': LatencyHistogram(), 'cpu': LatencyHistogram()}
+        wall_histogram, cpu_histogram = histograms['wall'], histograms['cpu']
+        name = base_name = '{}.{}'.format(func.__module__, func.__name__)
+        # the same name may belong to a method of another class, or to a function that was decorated again
+        number = 1
+        while latency_histograms.setdefault(name, histograms) is not histograms:
+            number += 1
+            name = '{}#{}'.format(base_name, number)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            wall_start, cpu_start = time.time(), _cpu_time()
+            try:
+                return func(*args, **kwds)
+            finally:
+                cpu_histogram.record(_cpu_time() - cpu_start)
+                wall_histogram.record(time.time() - wall_start)
+        wrapper.latency = histograms
+        wrapper.latency_name = name
+        wrapper.latency_summary = lambda: dict((kind, histogram.summary()) for kind, histogram in histograms.iteritems())
+        return wrapper
+
+
+class SpanExporter(object):
+    """Buffers finished `trace` spans and writes them to a file in batches of `batch_size` (and at exit)"""
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.spans = []
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if len(self.spans) < self.batch_size:
+                return
+            spans, self.spans = self.spans, []
+            self.write(spans)
+
+    def flush(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+            if spans:
+                self.write(spans)
+
+    def write(self, spans):
+        raise NotImplementedError('{} must implement write(spans)'.format(self.__class__.__name__))
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Appends each span to a file as a line of JSON"""
+    def write(self, spans):
+        with open(self.path, 'a') as fp:
+            fp.write(''.join(json.dumps(span, sort_keys=True) + '\n' for span in spans))
+
+
+class ChromeTraceSpanExporter(SpanExporter):
+    """Writes spans as complete ("X") events of the Chrome trace-event format, for chrome://tracing or Perfetto
+
+    The file is overwritten, and the JSON array is closed at exit (the viewers also accept it unclosed).
+    """
+    def __init__(self, path, batch_size=100):
+        super(ChromeTraceSpanExporter, self).__init__(path, batch_size=batch_size)
+        with open(self.path, 'w') as fp:
+            fp.write('[')
+        self.events_written = 0
+        self.closed = False
+        atexit.register(self.close)
+
+    def write(self, spans):
+        events = []
+        for span in spans:
+            events.append(json.dumps({
+                'name': span['name'], 'cat': 'pug', 'ph': 'X', 'pid': span['pid'], 'tid': span['thread'],
+                'ts': int(span['start'] * 1e6), 'dur': int(span['duration'] * 1e6),
+                'args': dict((k, span[k]) for k in ('id', 'parent_id', 'args', 'error')),
+                }, sort_keys=True))
+        with open(self.path, 'a') as fp:
+            fp.write((',\n' if self.events_written else '\n') + ',\n'.join(events))
+        self.events_written += len(events)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        with open(self.path, 'a') as fp:
+            fp.write('\n]\n')
+        self.closed = True
+
+
+# the spans that are in progress in this thread, innermost last
+_spans = threading.local()
+_span_ids = itertools.count(1)
+_args_repr = Repr()
+_args_repr.maxstring = _args_repr.maxother = 40
+
+
+class trace(log_with):
+    '''Decorator that records a span for each call, with its parent span (the traced call it was made from)
+
+    A span is a dict with the function `name`, `id`, `parent_id`, `trace_id` (id of the outermost span),
+    `start` time, `duration` in seconds, `pid`, `thread`, a short repr of the `args` and the `error` raised (or None).
+    Finished spans are handed to an `exporter`, like `JsonLinesSpanExporter` or `ChromeTraceSpanExporter`.
+    Entry and exit are also logged like `log_with`, at the DEBUG level by default.
+
+    >>> class ListExporter(object):
+    ...     spans = []
+    ...     def export(self, span):
+    ...         self.spans.append(span)
+    >>> @trace(ListExporter())
+    ... def inner(x):
+    ...     return x
+    >>> @trace(ListExporter())
+    ... def outer(x):
+    ...     return inner(x) + inner(x + 1)
+    >>> outer(1)
+    3
+    >>> [(s['name'], s['parent_id'] == ListExporter.spans[-1]['id'], s['args']) for s in ListExporter.spans]
+    [('inner', True, '(1)'), ('inner', True, '(2)'), ('outer', False, '(1)')]
+    '''
+    def __init__(self, exporter, logger=None, level=logging.DEBUG):
+        super(trace, self).__init__(logger=logger, level=level)
+        self.exporter = exporter
+
+    def __call__(self, func):
+        log_wrapper = super(trace, self).__call__(func)
+        exporter = self.exporter
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            stack = getattr(_spans, 'stack', None)
+            if stack is None:
+                stack = _spans.stack = []
+            parent = stack[-1] if stack else None
+            span = {
+                'name': name,
+                'id': next(_span_ids),
+                'parent_id': parent and parent['id'],
+                'pid': os.getpid(),
+                'thread': threading.current_thread().ident,
+                'error': None,
+                }
+            span['trace_id'] = parent['trace_id'] if parent else span['id']
+            span['args'] = '(' + ', '.join([_args_repr.repr(arg) for arg in args] +
+                                           ['{}={}'.format(k, _args_repr.repr(v)) for k, v in sorted(kwds.items())]) + ')'
+            stack.append(span)
+            span['start'] = time.time()
+            try:
+                return log_wrapper(*args, **kwds)
+            except BaseException as exc:
+                span['error'] = '{}: {}'.format(exc.__class__.__name__, exc)
+                raise
+            finally:
+                span['duration'] = time.time() - span['start']
+                stack.pop()
+                exporter.export(span)
+        return wrapper
+
 
 class dbname(object):
     'Decorator to add _db_name and _db_alias attributes to a class definition (typically a django Model)'
@@ -154,6 +1618,7 @@ class prefix_model_name_with_filename(object):
         self.remove_prefix = remove_prefix or 'models_'
 
     def __call__(self, cls):
+        from nlp.util import make_name
         model_name= os.path.basename(getmodule(cls).__file__).split('.')[0]
         kwargs = make_name.DJANGO_MODEL
         kwargs['remove_prefix'] = self.remove_prefix
@@ -164,6 +1629,78 @@ class prefix_model_name_with_filename(object):
         setattr(cls, '__name__', model_name + self.sep + getattr(cls, '__name__'))
         return cls
 
+class DbAliasRouter(object):
+    """Database router that sends the queries for models with a `_db_alias` (see `dbname`) to that database
+
+    Writes go to the `_db_alias` (the primary), reads go to its replicas in turn, if it has any.
+    Replicas are listed for each primary alias in the `replicas` dict, default `settings.DATABASE_REPLICAS`,
+    e.g. `{'sales': ['sales_replica1', 'sales_replica2']}`.
+    Models without a `_db_alias` are left to the next router in `settings.DATABASE_ROUTERS` (or the 'default' database).
+    Enable it with `DATABASE_ROUTERS = ['pug.decorators.DbAliasRouter']`.
+    """
+
+    def __init__(self, replicas=None):
+        from django.conf import settings
+        self.replicas = getattr(settings, 'DATABASE_REPLICAS', {}) if replicas is None else replicas
+        self.primaries = dict((replica, alias) for alias, replicas in self.replicas.iteritems() for replica in replicas)
+        # round-robin over the replicas of each alias
+        self.cycles = dict((alias, itertools.cycle(replicas)) for alias, replicas in self.replicas.iteritems() if replicas)
+
+    def db_for_read(self, model, **hints):
+        alias = getattr(model, '_db_alias', None)
+        if alias in self.cycles:
+            return next(self.cycles[alias])
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return getattr(model, '_db_alias', None)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Allow relations between objects in the same database, counting replicas as their primary"""
+        if getattr(obj1, '_db_alias', None) or getattr(obj2, '_db_alias', None):
+            db1, db2 = obj1._state.db, obj2._state.db
+            return self.primaries.get(db1, db1) == self.primaries.get(db2, db2)
+        return None
+
+    def allow_syncdb(self, db, model):
+        alias = getattr(model, '_db_alias', None)
+        if alias:
+            return db == alias
+        if db in self.primaries:
+            return False
+        return None
+
+
+@contextmanager
+def persistent_connections(*aliases):
+    """Keep the connections to `aliases` (default: all databases) open for a batch job, instead of reconnecting for every chunk
+
+    The connections are opened when the block starts and are exempt from `CONN_MAX_AGE`, so `close_old_connections()`
+    (which jobs call between chunks to drop broken connections) only closes them if they become unusable.
+    Connections that weren't open before the block are closed when it ends.
+    Yields a dict of the connections keyed by alias.
+
+    Each thread (or worker process) has its own connections, so use this in each of them.
+    """
+    from django.db import connections
+    aliases = aliases or connections
+    opened = {}
+    for alias in aliases:
+        connection = connections[alias]
+        opened[alias] = (connection, connection.connection is None)
+        connection.ensure_connection()
+        connection.close_at = None
+    try:
+        yield dict((alias, connection) for alias, (connection, was_closed) in opened.iteritems())
+    finally:
+        for connection, was_closed in opened.itervalues():
+            if was_closed:
+                connection.close()
+            elif connection.connection is not None:
+                max_age = connection.settings_dict['CONN_MAX_AGE']
+                connection.close_at = None if max_age is None else time.time() + max_age
+
+
 # import django_filters
 # import django.db.models.fields as django_field_types
 
@@ -229,92 +1766,589 @@ class prefix_model_name_with_filename(object):
 
 
 
+# precompiled `__unicode__` formatters of `represent`ed models, keyed by model class
+_representation_formatters = {}
+
+
+def _representation_formatter(cls):
+    """A function that renders instances of `cls` exactly like `nlp.db.representation`, with the field names looked up once
+
+    The field names are the first of the class's `IMPORTANT_FIELDS`, `_IMPORTANT_FIELDS`, `_important_fields`,
+    `REPR_FIELDS`, `_REPR_FIELDS` or `_repr_fields`, or else 'pk' and the first few of `_meta.get_all_field_names()`.
+    """
+    from nlp.db import representation
+    all_names = cls._meta.get_all_field_names()
+    field_names = None
+    for field_names_name in ('IMPORTANT_FIELDS', '_IMPORTANT_FIELDS', '_important_fields', 'REPR_FIELDS', '_REPR_FIELDS', '_repr_fields'):
+        field_names = getattr(cls, field_names_name, None)
+        if field_names:
+            break
+    field_names = field_names or (['pk'] + all_names[:min(representation.default_fields, len(all_names))])
+    field_names = tuple(field_names[:min(len(field_names), representation.max_fields)])
+    template = cls.__name__ + '(' + ', '.join(['%s'] * len(field_names)) + ')'
+
+    def formatter(obj):
+        return template % tuple([repr(getattr(obj, name, '') or '') for name in field_names])
+    return formatter
+
+
 def represent(cls):
-    setattr(cls, '__unicode__', representation)
+    """Give a model a `__unicode__` like `nlp.db.representation`, e.g. `Author(1, u'Hobson')`
+
+    The formatter for each model class is built on its first use rather than here,
+    so that reverse relations added by models defined later are included in its field names, as they would be by `representation`.
+    """
+    def __unicode__(self):
+        try:
+            formatter = _representation_formatters[self.__class__]
+        except KeyError:
+            formatter = _representation_formatters[self.__class__] = _representation_formatter(self.__class__)
+        return formatter(self)
+    setattr(cls, '__unicode__', __unicode__)
     return cls
 
-# FIXME, DRY these 3 models up by just adding a kwarg to select between the 2 decorators
-#        very unDRY (only a few characters changed in each!)
-def _link_rels(obj, fields=None, save=False, overwrite=False):
-    """Populate any database related fields (ForeignKeyField, OneToOneField) that have `_get`ters to populate them with"""
-    if not fields:
-        meta = obj._meta
-        fields = [f.name for f in meta.fields if hasattr(f, 'do_related_class') and not f.primary_key and hasattr(meta, '_get_' + f.name) and hasattr(meta, '_' + f.name)]
-    for field in fields:
+FieldPlan = namedtuple('FieldPlan', 'name attname getter related null field depends')
+
+# precompiled FieldPlans, keyed by (model class, field names or None, related)
+_field_plans = {}
+
+
+def _field_plan(cls, fields=None, related=None):
+    """The fields of `cls` that have `_get_<field>` and `_<field>` getters, with everything `_update` needs to populate them
+
+    Each `FieldPlan` has the field `name` and `attname` (column attribute, `<name>_id` for foreign keys),
+    a `getter` (`operator.attrgetter('_<field>')`), whether it is a `related` field, whether it may be `null`,
+    the Django `field` itself (None for `fields` that aren't model fields),
+    and the attnames of the source fields it `depends` on, from the model's `_depends_on` dict (`{'<field>': ('<source field>', ...)}`),
+    or None if the model doesn't declare what the `_<field>` getter reads.
+    `related=True` only includes related fields (ForeignKeys), `related=False` excludes them.
+    Plans are built once for each class and set of arguments, so applying one does no introspection.
+    """
+    key = (cls, tuple(fields) if fields else None, related)
+    try:
+        return _field_plans[key]
+    except KeyError:
+        pass
+    from django.db.models.fields import FieldDoesNotExist
+    from django.db.models.fields.related import RelatedField
+    if fields:
+        selected = []
+        for name in fields:
+            try:
+                selected.append(cls._meta.get_field(name))
+            except FieldDoesNotExist:
+                selected.append(name)
+    else:
+        selected = [f for f in cls._meta.fields if not f.primary_key and hasattr(cls, '_get_' + f.name) and hasattr(cls, '_' + f.name)
+                    and (related is None or isinstance(f, RelatedField) == related)]
+    depends_on = getattr(cls, '_depends_on', None) or {}
+    plan = []
+    for field in selected:
+        name = field if isinstance(field, basestring) else field.name
+        depends = depends_on.get(name)
+        if depends is not None:
+            depends = tuple(cls._meta.get_field(source).attname for source in depends)
+        if isinstance(field, basestring):
+            plan.append(FieldPlan(field, field, operator.attrgetter('_' + field), False, True, None, depends))
+        else:
+            plan.append(FieldPlan(field.name, field.attname, operator.attrgetter('_' + field.name),
+                                  isinstance(field, RelatedField), field.null, field, depends))
+    plan = _field_plans[key] = tuple(plan)
+    return plan
+
+
+def _apply_field_plan(obj, plan, overwrite=False, dirty=None, changed=None):
+    """Populate the fields in `plan` from their getters and return the names of the fields that got a (non-null) value
+
+    Fields that already have a value are skipped unless `overwrite` is set, or the `dirty` source fields (attnames)
+    of `obj` are known and include one that the field `depends` on (so its value is stale).
+    The names of the fields whose value actually changed are appended to the `changed` list.
+    """
+    fields_updated = []
+    for field in plan:
         # skip fields if they contain non-null data and `overwrite` option wasn't set
-        if not overwrite and not isinstance(getattr(obj, field, None), NoneType):
-            # print 'skipping %s which already has a value of %s' % (field, getattr(obj, field, None))
+        # (the attname of a ForeignKey can be checked without a query for the related object)
+        old_value = getattr(obj, field.attname, None)
+        if old_value is not None and not overwrite:
+            if dirty is None or field.depends is None or dirty.isdisjoint(field.depends):
+                continue
+        try:
+            value = field.getter(obj)
+        except AttributeError:
+            value = None
+        if value is None and not field.null:
             continue
-        if hasattr(obj, field):
-            setattr(obj, field, getattr(obj, '_' + field, None))
+        setattr(obj, field.name, value)
+        if value is not None:
+            fields_updated.append(field.name)
+        if changed is not None and getattr(obj, field.attname, None) != old_value:
+            changed.append(field.name)
+    return fields_updated
+
+
+def _snapshot_sources(instance, sources):
+    """Remember the values of the `sources` (attnames) of `instance`, so `_dirty_fields` can tell which of them have changed"""
+    # deferred fields aren't in the instance __dict__ and are never dirty, so they aren't loaded just to remember them
+    values = instance.__dict__
+    instance._clean_sources = dict((name, values[name]) for name in sources if name in values)
+
+
+def _dirty_fields(obj):
+    """The set of source fields (attnames) of a saved `obj` that changed since it was loaded or saved, None if they aren't tracked"""
+    clean = obj.__dict__.get('_clean_sources')
+    if clean is None or obj.pk is None:
+        return None
+    values = obj.__dict__
+    return set(name for name, value in clean.iteritems() if values.get(name, value) != value)
+
+
+def _link_rels(obj, fields=None, save=False, overwrite=False, plan=None):
+    """Populate any database related fields (ForeignKeyField, OneToOneField) that have `_get`ters to populate them with"""
+    _apply_field_plan(obj, plan or _field_plan(obj.__class__, fields, related=True), overwrite=overwrite)
     if save:
         obj.save()
     return obj
 
-def _denormalize(obj, fields=None, save=False, overwrite=False):
+def _denormalize(obj, fields=None, save=False, overwrite=False, plan=None):
     """Update/populate any database fields that are not related fields (FKs) but have `_get`ters to populate them with"""
-    if not fields:
-        meta = obj._meta
-        fields = [f.name for f in meta.fields if not hasattr(f, 'do_related_class') and not f.primary_key and hasattr(meta, '_get_' + f.name) and hasattr(meta, '_' + f.name)]
-    for field in fields:
-        # skip fields if they contain non-null data and `overwrite` option wasn't set
-        if not overwrite and not isinstance(getattr(obj, field, None), NoneType):
-            # print 'skipping %s which already has a value of %s' % (field, getattr(obj, field, None))
-            continue
-        if hasattr(obj, field):
-            setattr(obj, field, getattr(obj, '_' + field, None))
+    _apply_field_plan(obj, plan or _field_plan(obj.__class__, fields, related=False), overwrite=overwrite)
     if save:
         obj.save()
     return obj
 
-def _update(obj, fields=None, save=False, overwrite=False):
-    """Update/populate any database fields that have `_get`ters to populate them with, regardless of whether they are data fields or related fields"""
-    if not fields:
-        meta = obj._meta
-        fields = [f.name for f in meta.fields if not f.primary_key and hasattr(meta, '_get_' + f.name) and hasattr(meta, '_' + f.name)]
-    # print fields
-    fields_updated = []
-    for field in fields:
-        # skip fields if they contain non-null data and `overwrite` option wasn't set
-        if not overwrite and not getattr(obj, field, None) == None:
-            # print 'skipping %s which already has a value of %s' % (field, getattr(obj, field, None))
-            continue
-        # print field
-        if hasattr(obj, field):
-            # print field, getattr(obj, '_' + field, None)
-            setattr(obj, field, getattr(obj, '_' + field, None))
-            if getattr(obj, field, None) != None:
-                fields_updated += [field]
+def _update(obj, fields=None, save=False, overwrite=False, plan=None, update_fields=False):
+    """Update/populate any database fields that have `_get`ters to populate them with, regardless of whether they are data fields or related fields
+
+    For a model that declares which source fields each getter reads (`_depends_on`), fields whose sources changed
+    since the instance was loaded (or saved) are recomputed even if they already have a value.
+    With `update_fields=True` (or a list of the other fields the caller changed) `save` only writes those fields,
+    the dirty sources, the fields that changed and any `auto_now` fields, or nothing at all if none of them changed.
+    Otherwise the whole instance is saved.
+    """
+    dirty = _dirty_fields(obj)
+    changed = []
+    fields_updated = _apply_field_plan(obj, plan or _field_plan(obj.__class__, fields), overwrite=overwrite, dirty=dirty, changed=changed)
     if save:
-        obj.save()
+        if not update_fields or dirty is None:
+            obj.save()
+        else:
+            names = dirty.union(changed)
+            if update_fields is not True:
+                names.update(update_fields)
+            if names:
+                # Django only sets auto_now fields (e.g. `audit`'s `updated`) that are in update_fields
+                names.update(f.name for f in obj._meta.fields if getattr(f, 'auto_now', False))
+                obj.save(update_fields=sorted(names))
     return fields_updated
 
+def _chunks(iterable, size):
+    """Yield lists of up to `size` items from any iterable (queryset iterators included)"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _max_query_params(connection):
+    """Most parameters a single query may have (old SQLite builds are compiled with a limit of 999)"""
+    return 999 if connection.vendor == 'sqlite' else 32767
+
+
+def _update_changed_columns(model, changes, using):
+    """Write `changes`, a dict of {field: [(pk, value), ...]}, with as few `UPDATE ... SET col = CASE pk WHEN ...` queries as possible
+
+    Each query sets every changed column of a group of rows, and leaves a column alone (`ELSE col`)
+    for the rows in the group that didn't change it.
+    Returns the number of rows updated.
+    """
+    from django.db import connections
+    if not changes:
+        return 0
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_field = model._meta.pk
+    values = dict((field, dict(rows)) for field, rows in changes.iteritems())
+    pks = sorted(set(pk for rows in values.itervalues() for pk in rows))
+    rows_per_query = max(1, _max_query_params(connection) // (1 + 2 * len(values)))
+    cursor = connection.cursor()
+    for start in range(0, len(pks), rows_per_query):
+        group = pks[start:start + rows_per_query]
+        assignments, params = [], []
+        for field, field_values in values.iteritems():
+            whens = []
+            for pk in group:
+                if pk in field_values:
+                    whens.append('WHEN %s THEN %s')
+                    params += [pk_field.get_db_prep_value(pk, connection=connection),
+                               field.get_db_prep_save(field_values[pk], connection=connection)]
+            if whens:
+                assignments.append('{0} = CASE {1} {2} ELSE {0} END'.format(qn(field.column), qn(pk_field.column), ' '.join(whens)))
+        params += [pk_field.get_db_prep_value(pk, connection=connection) for pk in group]
+        cursor.execute('UPDATE {} SET {} WHERE {} IN ({})'.format(
+            qn(model._meta.db_table), ', '.join(assignments), qn(pk_field.column), ', '.join(['%s'] * len(group))), params)
+    return len(pks)
+
+
+def _bulk_update(model, queryset=None, fields=None, batch_size=1000, overwrite=False, plan=None):
+    """Run the `_<field>` getters of every row in a queryset and write only the changed rows and columns in batched UPDATEs
+
+    The queryset (default: all rows of `model`) is streamed with `.iterator()` in chunks of `batch_size` rows,
+    and the changes of each chunk are written in a transaction with one (or a few) `UPDATE` queries.
+    As with `_update`, fields that already have a value are skipped unless `overwrite` is set.
+    The UPDATEs go to the database the queryset was pinned to with `.using()`, otherwise to `router.db_for_write(model)`.
+    Returns the number of rows that changed.
+    """
+    from django.db import router, transaction
+    if queryset is None:
+        queryset = model._default_manager.all()
+    # `queryset.db` would be a read replica when DATABASE_ROUTERS route reads elsewhere
+    write_db = queryset._db or router.db_for_write(model)
+    plan = [field for field in plan or _field_plan(model, fields) if field.field is not None]
+    rows_updated = 0
+    for chunk in _chunks(queryset.iterator(), batch_size):
+        changes = OrderedDict()
+        for obj in chunk:
+            for field in plan:
+                # compare the raw column values (attname) so unset foreign keys don't need a query
+                old_value = getattr(obj, field.attname)
+                if not overwrite and old_value is not None:
+                    continue
+                try:
+                    value = field.getter(obj)
+                except AttributeError:
+                    value = None
+                if value is None and not field.null:
+                    continue
+                setattr(obj, field.name, value)
+                new_value = getattr(obj, field.attname)
+                if new_value != old_value:
+                    changes.setdefault(field.field, []).append((obj.pk, new_value))
+        with transaction.atomic(using=write_db):
+            rows_updated += _update_changed_columns(model, changes, write_db)
+    return rows_updated
+
+
+def _bulk_link_rels(model, objs=None, fields=None, batch_size=1000, save=False, overwrite=False, using=None, plan=None):
+    """Populate the related fields (ForeignKeys) of many objects with one query per related model per chunk, instead of one per object
+
+    `objs` may be a queryset (streamed with `.iterator()`, default: all rows of `model`) or a list of (unsaved) instances.
+    For a field to be linked in bulk, the model needs a `_key_<field>` getter that returns the natural key of the related object,
+    i.e. the value of its field named in the model's `_natural_keys` dict (`{'<field>': '<related field>'}`, default 'pk').
+    The natural keys of each chunk of `batch_size` objects are resolved with a single `__in` query per field.
+    Fields without a `_key_<field>` getter fall back to the `_<field>` getter of each object, like `_link_rels`.
+    With `save=True` the new foreign key values are written with batched UPDATEs (so the objects must already be saved).
+    Unless `using` names the database, related objects are read from `router.db_for_read` of their model
+    and the UPDATEs go to `router.db_for_write(model)`.
+    Returns the number of foreign keys assigned.
+    """
+    from django.db import connections, router, transaction
+    if objs is None:
+        objs = model._default_manager.all()
+    if hasattr(objs, 'iterator'):
+        # a queryset pinned to a database with `.using()`
+        using = using or objs._db
+        objs = objs.iterator()
+    # otherwise the queries go wherever the DATABASE_ROUTERS send them (e.g. to the model's `_db_alias`)
+    write_db = using or router.db_for_write(model)
+    plan = [field for field in plan or _field_plan(model, fields, related=True) if field.related]
+    natural_keys = getattr(model, '_natural_keys', {})
+    linked = 0
+    for chunk in _chunks(objs, batch_size):
+        changes = OrderedDict()
+        for field in plan:
+            unlinked = [obj for obj in chunk if overwrite or getattr(obj, field.attname) is None]
+            if not unlinked:
+                continue
+            if hasattr(model, '_key_' + field.name):
+                keys = [getattr(obj, '_key_' + field.name) for obj in unlinked]
+                lookup = natural_keys.get(field.name, 'pk')
+                related_model = field.field.rel.to
+                read_db = using or router.db_for_read(related_model)
+                manager = related_model._default_manager.db_manager(read_db)
+                max_values = _max_query_params(connections[read_db])
+                unique_keys = list(set(key for key in keys if key is not None))
+                related = {}
+                for start in range(0, len(unique_keys), max_values):
+                    for related_obj in manager.filter(**{lookup + '__in': unique_keys[start:start + max_values]}):
+                        related[getattr(related_obj, lookup)] = related_obj
+                values = [related.get(key) for key in keys]
+            else:
+                values = [getattr(obj, '_' + field.name, None) for obj in unlinked]
+            for obj, value in zip(unlinked, values):
+                if value is None:
+                    continue
+                old_value = getattr(obj, field.attname)
+                setattr(obj, field.name, value)
+                linked += 1
+                if save and getattr(obj, field.attname) != old_value:
+                    changes.setdefault(field.field, []).append((obj.pk, getattr(obj, field.attname)))
+        if save:
+            with transaction.atomic(using=write_db):
+                _update_changed_columns(model, changes, write_db)
+    return linked
+
+
 # TODO: make this a decotator class that accepts arguments which become default args of the link_rels method (fields, overwrite, save)
 def linkable_rels(cls):
-    fields = tuple(f.name for f in cls._meta.fields if isinstance(f, RelatedField) and hasattr(cls, '_get_' + f.name) and hasattr(cls, '_' + f.name))
-    # FIXME: instantiate a new copy of the _link_rels function and give it default arguments
-    def _customized_link_rels(obj, fields=fields, save=False, overwrite=False):
-        return _link_rels(obj, fields=fields, save=save, overwrite=overwrite)
+    # the fields and their getters are looked up once here, rather than for every object
+    plan = _field_plan(cls, related=True)
+
+    def _customized_link_rels(obj, fields=None, save=False, overwrite=False):
+        return _link_rels(obj, fields=fields, save=save, overwrite=overwrite, plan=None if fields else plan)
     setattr(cls, '_link_rels', _customized_link_rels)
+
+    def _customized_bulk_link_rels(model, objs=None, fields=None, batch_size=1000, save=False, overwrite=False, using=None):
+        return _bulk_link_rels(model, objs=objs, fields=fields, batch_size=batch_size, save=save, overwrite=overwrite, using=using,
+                               plan=None if fields else plan)
+    setattr(cls, '_bulk_link_rels', classmethod(_customized_bulk_link_rels))
     return cls
 
 
 # TODO: make this a decotator class that accepts arguments which become default args of the link_rels method (fields, overwrite, save)
 def updatable(cls):
-    fields = tuple(f.name for f in cls._meta.fields if not f.primary_key and hasattr(cls, '_get_' + f.name) and hasattr(cls, '_' + f.name))
-    # FIXME: instantiate a new copy of the _link_rels function and give it default arguments
-    def _customized_update(obj, fields=fields, save=False, overwrite=False):
-        return _update(obj, fields=fields, save=save, overwrite=overwrite)
+    from django.db.models import signals
+    # the fields and their getters are looked up once here, rather than for every object
+    plan = _field_plan(cls)
+
+    def _customized_update(obj, fields=None, save=False, overwrite=False, update_fields=False):
+        return _update(obj, fields=fields, save=save, overwrite=overwrite, plan=None if fields else plan, update_fields=update_fields)
     setattr(cls, '_update', _customized_update)
+
+    def _customized_bulk_update(model, queryset=None, fields=None, batch_size=1000, overwrite=False):
+        return _bulk_update(model, queryset=queryset, fields=fields, batch_size=batch_size, overwrite=overwrite,
+                            plan=None if fields else plan)
+    setattr(cls, '_bulk_update', classmethod(_customized_bulk_update))
+
+    def _customized_bulk_ingest(model, rows, columns=None, batch_size=1000, overwrite=False, using=None, logger=None):
+        return bulk_ingest(model, rows, columns=columns, batch_size=batch_size, overwrite=overwrite, using=using, logger=logger,
+                           plan=plan)
+    setattr(cls, '_bulk_ingest', classmethod(_customized_bulk_ingest))
+
+    # track changes to the source fields declared in `_depends_on`, so `_update` only recomputes what they affect
+    sources = tuple(sorted(set(source for field in plan for source in field.depends or ())))
+    if sources:
+        def _track_sources(sender, instance, **kwargs):
+            _snapshot_sources(instance, sources)
+        signals.post_init.connect(_track_sources, sender=cls, weak=False, dispatch_uid=('updatable', cls))
+        signals.post_save.connect(_track_sources, sender=cls, weak=False, dispatch_uid=('updatable', cls))
+        setattr(cls, '_dirty_fields', _dirty_fields)
     return cls
 
 
+UpdateProgress = namedtuple('UpdateProgress', 'chunks rows updated seconds failed')
+
+
+def _pk_ranges(model, chunk_size, queryset):
+    """Split the (integer) primary key range of the rows in `queryset` into half-open `(lo, hi)` ranges of `chunk_size` keys"""
+    from django.db.models import Max, Min
+    pk_name = model._meta.pk.name
+    bounds = queryset.aggregate(lo=Min(pk_name), hi=Max(pk_name))
+    if bounds['lo'] is None:
+        return []
+    return [(lo, min(lo + chunk_size, bounds['hi'] + 1)) for lo in range(bounds['lo'], bounds['hi'] + 1, chunk_size)]
+
+
+def _update_pk_range(args):
+    """Run `_bulk_update` on the rows of a model with primary keys in `[lo, hi)`, in a pool worker
+
+    `where` is an optional `(sql, params)` WHERE clause selecting the rows to update (querysets can't be sent to workers:
+    pickling one evaluates it, and unpickling its query only works for models in INSTALLED_APPS).
+    Returns `(lo, hi, rows, updated, error)` rather than raising, so that the chunk can be retried.
+    """
+    model, where, using, lo, hi, fields, overwrite, batch_size = args
+    try:
+        queryset = model._default_manager.using(using).filter(pk__gte=lo, pk__lt=hi)
+        if where:
+            queryset = queryset.extra(where=[where[0]], params=where[1])
+        rows = queryset.count()
+        updated = _bulk_update(model, queryset=queryset, fields=fields, batch_size=batch_size, overwrite=overwrite)
+        return lo, hi, rows, updated, None
+    except Exception as e:
+        return lo, hi, 0, 0, '{}: {}'.format(e.__class__.__name__, e)
+
+
+def parallel_update(model, queryset=None, fields=None, overwrite=False, processes=None, chunk_size=10000, batch_size=1000,
+                    retries=2, using=None, logger=None):
+    """Denormalize a large table with `_bulk_update` in a pool of worker processes, one primary key range (chunk) at a time
+
+    The integer primary key range of `queryset` (default: all rows of `model`) is split into chunks of `chunk_size` keys.
+    Each worker process opens its own database connection (all of the parent's connections are closed before the pool forks),
+    so `using` must name a database that other processes can reach (not an in-memory SQLite database)
+    unless `processes=1`, which runs every chunk in this process.
+    `using` defaults to the database the queryset was pinned to with `.using()`, otherwise `router.db_for_write(model)`,
+    so that the rows are scanned and updated on the primary rather than on a read replica.
+    Progress and throughput are logged at INFO level for each chunk.
+    Chunks that raise are retried up to `retries` times; those that still fail are listed in the result.
+    Returns an `UpdateProgress(chunks, rows, updated, seconds, failed)` where `failed` is a list of `(lo, hi, error)`.
+    """
+    import multiprocessing
+    from django.db import connections, router
+    logger = logger or log
+    if queryset is None:
+        queryset = model._default_manager.all()
+    using = using or queryset._db or router.db_for_write(model)
+    processes = processes or multiprocessing.cpu_count()
+    queryset = queryset.using(using)
+    pending = _pk_ranges(model, chunk_size, queryset)
+    where = None
+    if queryset.query.where:
+        sql, params = queryset.values('pk').query.get_compiler(using).as_sql()
+        pk = model._meta.pk
+        where = ('{}.{} IN ({})'.format(connections[using].ops.quote_name(model._meta.db_table),
+                                        connections[using].ops.quote_name(pk.column), sql), params)
+    num_chunks, done, rows, updated, failed = len(pending), 0, 0, 0, []
+    t0 = time.time()
+    pool = None
+    if processes > 1:
+        # a connection (socket) shared with forked children would be corrupted by their queries,
+        # and routers or signal handlers in the children may use any database, not just `using`
+        for conn in connections.all():
+            conn.close()
+        pool = multiprocessing.Pool(processes)
+    try:
+        for attempt in range(retries + 1):
+            failed = []
+            tasks = [(model, where, using, lo, hi, fields, overwrite, batch_size) for lo, hi in pending]
+            results = pool.imap_unordered(_update_pk_range, tasks) if pool else itertools.imap(_update_pk_range, tasks)
+            for lo, hi, chunk_rows, chunk_updated, error in results:
+                if error:
+                    logger.warning('Chunk pk %s-%s failed (attempt %s of %s): %s', lo, hi, attempt + 1, retries + 1, error)
+                    failed.append((lo, hi, error))
+                    continue
+                done += 1
+                rows += chunk_rows
+                updated += chunk_updated
+                seconds = time.time() - t0
+                logger.info('Chunk pk %s-%s done: %s/%s chunks, %s rows (%s updated), %.0f rows/s',
+                            lo, hi, done, num_chunks, rows, updated, rows / seconds if seconds else 0)
+            if not failed:
+                break
+            pending = [(lo, hi) for lo, hi, error in failed]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return UpdateProgress(num_chunks, rows, updated, time.time() - t0, failed)
+
+
+def _read_csv(path, encoding='utf-8', **kwargs):
+    """Generate a dict for each row of the CSV file at `path`, with unicode values, without loading the whole file"""
+    import csv
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f, **kwargs):
+            yield dict((k, v.decode(encoding) if isinstance(v, str) else v) for k, v in row.iteritems())
+
+
+def bulk_ingest(model, rows, columns=None, batch_size=1000, overwrite=False, using=None, logger=None, plan=None):
+    """Stream `rows` into the table of an `updatable` model with batched `bulk_create`s, denormalizing each chunk on the way in
+
+    `rows` is an iterable of dicts (e.g. a `csv.DictReader` or a generator) or the path of a CSV file.
+    `columns` maps row keys to field names (default: keys that are field names are used as is, the rest are ignored).
+    Values are converted with each field's `to_python` (with empty strings stored as null for nullable fields),
+    then the instances of each chunk of `batch_size` rows are populated with the model's compiled `_<field>` getters
+    (fields given in the rows are kept unless `overwrite` is set) and inserted with one `bulk_create` per chunk.
+    Only one chunk is held in memory at a time. Throughput is logged at INFO level for each chunk.
+    Rows are written to the `using` database (default: the one `DATABASE_ROUTERS` choose for writing `model`).
+    Returns the number of rows inserted.
+    """
+    from django.db import router, transaction
+    from django.db.models.fields import FieldDoesNotExist
+    logger = logger or log
+    using = using or router.db_for_write(model)
+    if isinstance(rows, basestring):
+        rows = _read_csv(rows)
+    plan = plan or _field_plan(model)
+    converters, t0, inserted = None, time.time(), 0
+    for chunk in _chunks(iter(rows), batch_size):
+        if converters is None:
+            # map the columns of the first row to fields (and their converters) once, rather than for every value
+            converters = []
+            for key in chunk[0]:
+                name = columns.get(key) if columns else key
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    continue
+                converters.append((key, field.attname, field.to_python, field.null))
+        objs = []
+        for row in chunk:
+            kwargs = {}
+            for key, attname, to_python, null in converters:
+                value = row[key]
+                kwargs[attname] = None if null and value == '' else to_python(value)
+            obj = model(**kwargs)
+            _apply_field_plan(obj, plan, overwrite=overwrite)
+            objs.append(obj)
+        with transaction.atomic(using=using):
+            model._default_manager.db_manager(using).bulk_create(objs)
+        inserted += len(objs)
+        seconds = time.time() - t0
+        logger.info('Inserted %s rows into %s, %.0f rows/s', inserted, model._meta.db_table, inserted / seconds if seconds else 0)
+    return inserted
+
+
 def audit(cls):
-    setattr(cls, 'updated', models.DateTimeField(auto_now=True))
-    setattr(cls, 'created', models.DateTimeField(auto_now_add=True))
+    from django.db import models
+    # fields set with setattr after the class is created wouldn't be added to its _meta (or its table)
+    cls.add_to_class('updated', models.DateTimeField(auto_now=True))
+    cls.add_to_class('created', models.DateTimeField(auto_now_add=True))
     return cls
 
 
+class memoize_audited(memoize):
+    '''Decorator to memoize an expensive getter of an `audit`ed model, for as long as the row isn't saved again
+
+    Values are cached for each row (model, pk and any other arguments) along with the row's `updated` timestamp,
+    and only returned for an instance with the same `updated`, so an entry goes stale as soon as the row is saved
+    (`updated` is `auto_now`), and is then recomputed and replaced.
+    Unsaved instances (or rows without an `updated` time) are computed every time, and so are instances of `updatable`
+    models with source fields (in `_depends_on`) that were changed in memory since the row was loaded or saved.
+    Use it under the `_<field>` getters that `_update` and `_link_rels` call, e.g. `_length = property(memoize_audited(_get_length))`,
+    and `prefetch` a queryset to warm the cache for all of its rows with a single query.
+    `maxsize`, `maxbytes` and `backend` work the same as for `memoize`.
+    '''
+    def __init__(self, func, **kwargs):
+        if kwargs.get('ttl') or kwargs.get('single_flight') or kwargs.get('coroutine') or kwargs.get('generator'):
+            raise ValueError('memoize_audited does not support ttl, single_flight, coroutines or generators.')
+        kwargs.update(coroutine=False, generator=False)
+        super(memoize_audited, self).__init__(func, **kwargs)
+
+    def __call__(self, obj, *args, **kwargs):
+        updated = getattr(obj, 'updated', None)
+        if obj.pk is None or updated is None or _dirty_fields(obj):
+            return self.func(obj, *args, **kwargs)
+        cache_key = (obj.__class__, obj.pk, self.key(args, kwargs))
+        try:
+            cached_updated, value = self.cache[cache_key]
+        except KeyError:
+            pass
+        else:
+            if cached_updated == updated:
+                self.hits += 1
+                if self.bounded:
+                    self._touch(cache_key)
+                return value
+        self.misses += 1
+        value = self._compute((obj,) + args, kwargs)
+        self._store(cache_key, (updated, value))
+        return value
+
+    def __get__(self, obj, objtype=None):
+        # the class attribute is the cache itself, e.g. `Model._get_field.prefetch(queryset)`
+        if obj is None:
+            return self
+        return functools.partial(self.__call__, obj)
+
+    def prefetch(self, queryset, *args, **kwargs):
+        """Compute the value for every row in `queryset` (retrieved with one query) that isn't already cached, return how many were computed"""
+        misses = self.misses
+        for obj in queryset.iterator():
+            self(obj, *args, **kwargs)
+        return self.misses - misses
+
+
 # class dbname(object):
 #     'Decorator to add _db_name and _db_alias attributes to a class definition'
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for pug.decorators
+
+Run with `python -m pug.tests.bench_decorators` (not collected by the test runners).
+"""
+
+import timeit
+
+from nlp.util import force_hashable
+
+from pug import decorators
+
+
+def legacy_key(args, kwargs):
+    """The cache key that memoize built for every call before `make_key` was added"""
+    return (force_hashable(args), force_hashable(kwargs.items()))
+
+
+def per_call_usec(stmt, setup='pass', number=100000, repeat=3):
+    """Best of `repeat` timings of `stmt` (a string or a callable) in microseconds per call"""
+    return min(timeit.repeat(stmt, setup=setup, number=number, repeat=repeat)) * 1e6 / number
+
+
+def bench_memoize_key(number=100000):
+    """Print the per-call cost of building a cache key and of a cache hit, before and after `make_key`"""
+    setup = 'from pug.tests.bench_decorators import legacy_key, decorators; args, kwargs = {}'
+    cases = (
+        ('scalars', '(1, "two", 3.0), {"four": 4}'),
+        ('unhashable', '([1, 2, 3], "two"), {"four": {"f": 4}}'),
+        )
+    for name, arguments in cases:
+        print '{:>12} key   legacy: {:6.2f} us   make_key: {:6.2f} us'.format(
+            name,
+            per_call_usec('legacy_key(args, kwargs)', setup.format(arguments), number=number),
+            per_call_usec('decorators.make_key(args, kwargs)', setup.format(arguments), number=number))
+
+    def add(x, y=0):
+        return x + y
+
+    def legacy_memoized(*args, **kwargs):
+        cache_key = legacy_key(args, kwargs)
+        try:
+            return legacy_cache[cache_key]
+        except KeyError:
+            value = legacy_cache[cache_key] = add(*args, **kwargs)
+            return value
+    legacy_cache = {}
+    memoized = decorators.memoize(add)
+    print '{:>12} hit   legacy: {:6.2f} us   memoize:  {:6.2f} us   (unmemoized call: {:.2f} us)'.format(
+        'add(1, y=2)',
+        per_call_usec(lambda: legacy_memoized(1, y=2), number=number),
+        per_call_usec(lambda: memoized(1, y=2), number=number),
+        per_call_usec(lambda: add(1, y=2), number=number))
+
+
+def bench_represent(n=10000, repeat=3):
+    """Print the time to render `n` unsaved model instances with `represent`'s formatter and with `nlp.db.representation`"""
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    from django.db import models
+    from nlp.db import representation
+
+    @decorators.represent
+    class BenchRow(models.Model):
+        name = models.CharField(max_length=32)
+        email = models.CharField(max_length=64)
+        score = models.FloatField()
+
+        class Meta:
+            app_label = 'pug_bench'
+
+    objs = [BenchRow(pk=i, name='row {}'.format(i), email='row{}@example.com'.format(i), score=i / 7.) for i in range(n)]
+    assert [unicode(obj) for obj in objs] == [representation(obj) for obj in objs]
+    print '{:>12} {} instances   representation: {:6.1f} ms   represent: {:6.1f} ms'.format(
+        'unicode()', n,
+        min(timeit.repeat(lambda: [representation(obj) for obj in objs], number=1, repeat=repeat)) * 1e3,
+        min(timeit.repeat(lambda: [unicode(obj) for obj in objs], number=1, repeat=repeat)) * 1e3)
+
+
+if __name__ == '__main__':
+    bench_memoize_key()
+    bench_represent()
@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+"""
+Uses the unittest module to test the pug.decorators module with `manage.py test`.
+"""
+
+from unittest import TestCase, main
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import gc
+import weakref
+import json
+import logging
+from StringIO import StringIO
+from unittest import skipIf
+import doctest
+from pug import decorators
+
+
+class DecoratorsDocTest(TestCase):
+
+    def test_module(self, module=decorators):
+        failure_count, test_count = doctest.testmod(module, raise_on_error=False, verbose=False)
+        msg = "Ran {0} tests in {3} and {1} passed ({2} failed)".format(test_count, test_count-failure_count, failure_count, module.__file__)
+        print msg
+        if failure_count:
+            self.fail(msg)
+
+
+class ImportTest(TestCase):
+
+    def test_import_time(self):
+        # in a fresh interpreter, since this one has already imported everything
+        code = '; '.join([
+            'import sys, time',
+            'import pug',
+            't0 = time.time()',
+            'import pug.decorators',
+            'print time.time() - t0',
+            'print sorted(set(m.split(".")[0] for m in sys.modules if m.split(".")[0] in ("django", "nlp", "trollius", "asyncio")))',
+            ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+        seconds, lazy_modules = subprocess.check_output([sys.executable, '-c', code], env=env).splitlines()
+        self.assertEqual(lazy_modules, '[]')
+        self.assertTrue(float(seconds) < 0.5, 'import pug.decorators took {} s'.format(seconds))
+
+
+class MemoizeTest(TestCase):
+
+    def test_lru_eviction_order(self):
+        calls = []
+
+        @decorators.memoize(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        square(1)
+        square(2)
+        square(1)  # 1 is now the most recently used, so 2 is evicted next
+        square(3)
+        square(1)
+        self.assertEqual(calls, [1, 2, 3])
+        square(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+        self.assertEqual(square.cache_info().evictions, 2)
+
+    def test_unbounded_by_default(self):
+        @decorators.memoize
+        def ident(x):
+            return x
+
+        for i in range(100):
+            ident(i)
+        info = ident.cache_info()
+        self.assertEqual((info.misses, info.evictions, info.maxsize, info.currsize), (100, 0, None, 100))
+
+    def test_maxbytes_eviction(self):
+        import numpy as np
+
+        @decorators.memoize(maxbytes=8000 * 2.5)
+        def filled(value, n=1000):
+            return np.zeros(n) + value
+
+        for value in range(4):
+            filled(value)
+        info = filled.cache_info()
+        self.assertEqual((info.currsize, info.evictions, info.currbytes), (2, 2, 8000 * 2))
+        filled(0, n=10000)  # bigger than the whole budget so it isn't cached
+        self.assertEqual(filled.cache_info().currbytes, 8000 * 2)
+        filled.cache_clear()
+        self.assertEqual(filled.cache_info().currbytes, 0)
+
+    def test_ttl_expiry(self):
+        calls = []
+
+        @decorators.memoize(ttl=0.05)
+        def stamp(x):
+            calls.append(x)
+            return len(calls)
+
+        self.assertEqual(stamp('a'), 1)
+        self.assertEqual(stamp('a'), 1)
+        time.sleep(0.1)
+        self.assertEqual(stamp('a'), 2)
+        # the periodic purge removes entries that nobody asked for again
+        stamp('b')
+        time.sleep(0.1)
+        stamp.purge()
+        self.assertEqual(len(stamp.cache), 0)
+
+    def test_stale_while_revalidate(self):
+        calls = []
+
+        @decorators.memoize(ttl=0.05, stale_while_revalidate=10)
+        def stamp(x):
+            calls.append(x)
+            return len(calls)
+
+        self.assertEqual(stamp('a'), 1)
+        time.sleep(0.1)
+        # the stale value is returned right away while a background thread recomputes it
+        self.assertEqual(stamp('a'), 1)
+        for i in range(100):
+            if not stamp.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(stamp('a'), 2)
+
+    def test_single_flight(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @decorators.memoize(single_flight=True)
+        def slow(x):
+            calls.append(x)
+            started.set()
+            release.wait()
+            if x < 0:
+                raise ValueError(x)
+            return x * 10
+
+        for x in (1, -1):
+            started.clear()
+            release.clear()
+            results = []
+
+            def call():
+                try:
+                    results.append(slow(x))
+                except ValueError as exc:
+                    results.append(exc)
+
+            threads = [threading.Thread(target=call) for i in range(8)]
+            threads[0].start()
+            started.wait()
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), 8)
+            if x > 0:
+                self.assertEqual(results, [10] * 8)
+            else:
+                self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(calls, [1, -1])
+        # exceptions are shared with the waiting threads but not cached
+        self.assertRaises(ValueError, slow, -1)
+        self.assertEqual(calls, [1, -1, -1])
+
+
+class MemoizeRegistryTest(TestCase):
+
+    def test_snapshot_and_clear_all(self):
+        @decorators.memoize
+        def slow_square(x):
+            time.sleep(0.01)
+            return x * x
+
+        for x in (1, 2, 1, 1):
+            slow_square(x)
+        fp = StringIO()
+        decorators.dump_memoize_stats(fp)
+        stats = [s for s in json.loads(fp.getvalue())['caches'] if s['name'] == 'slow_square']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['module'], stats[0]['entries'], stats[0]['hits'], stats[0]['misses']),
+                         (__name__, 2, 2, 2))
+        self.assertTrue(stats[0]['nbytes'] > 0)
+        self.assertTrue(stats[0]['seconds_saved'] >= 0.015)
+        decorators.clear_all()
+        self.assertEqual(slow_square.cache_info().currsize, 0)
+        self.assertTrue(slow_square in decorators.memoized_functions())
+        del slow_square
+        gc.collect()
+        self.assertFalse([m for m in decorators.memoized_functions() if m.func.__name__ == 'slow_square'])
+
+    def test_memoize_method_listed_once(self):
+        class Squarer(object):
+            @decorators.memoize_method
+            def square_each(self, x):
+                return x * x
+
+        registered = len(decorators.memoized_functions())
+        squarers = [Squarer() for i in range(100)]
+        for squarer in squarers:
+            squarer.square_each(2), squarer.square_each(2)
+        # the instances' caches aren't registered themselves
+        self.assertEqual(len(decorators.memoized_functions()), registered)
+        stats = [s for s in decorators.memoize_stats() if s['name'] == 'square_each']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['instances'], stats[0]['entries'], stats[0]['hits'], stats[0]['misses']),
+                         (100, 100, 100, 100))
+        decorators.clear_all()
+        self.assertEqual(Squarer.square_each.cache_info().currsize, 0)
+        del squarers[50:], squarer
+        gc.collect()
+        self.assertEqual(Squarer.square_each.stats()['instances'], 50)
+
+
+@skipIf(decorators._import_asyncio() is None, 'requires asyncio (or trollius on python 2.7)')
+class MemoizeCoroutineTest(TestCase):
+
+    def test_shared_task_and_uncached_failures(self):
+        asyncio = decorators._import_asyncio()
+        calls = []
+
+        @decorators.memoize
+        @asyncio.coroutine
+        def fetch(x):
+            calls.append(x)
+            yield asyncio.sleep(0.01)
+            if x < 0:
+                raise ValueError(x)
+            raise asyncio.Return(x * 2)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            results = loop.run_until_complete(asyncio.gather(fetch(1), fetch(1), fetch(1)))
+            self.assertEqual(results, [2, 2, 2])
+            self.assertEqual(loop.run_until_complete(fetch(1)), 2)
+            self.assertEqual(calls, [1])
+            self.assertEqual((fetch.cache_info().hits, fetch.cache_info().misses), (1, 1))
+            results = loop.run_until_complete(asyncio.gather(fetch(-1), fetch(-1), return_exceptions=True))
+            self.assertTrue(all(isinstance(result, ValueError) for result in results))
+            self.assertRaises(ValueError, loop.run_until_complete, fetch(-1))
+            self.assertEqual(calls, [1, -1, -1])
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class MemoizeGeneratorTest(TestCase):
+
+    def test_max_recorded(self):
+        calls = []
+
+        @decorators.memoize(max_recorded=3)
+        def count(n):
+            calls.append(n)
+            for i in range(n):
+                yield i
+
+        self.assertEqual(list(count(2)), [0, 1])
+        self.assertEqual(list(count(2)), [0, 1])
+        self.assertEqual(calls, [2])
+        short = count(5)
+        self.assertEqual([next(short) for i in range(3)], [0, 1, 2])
+        replay = count(5)
+        self.assertEqual(list(short), [3, 4])
+        # the recording was dropped, so the replay restarts the generator after the 3 recorded items
+        self.assertEqual(list(replay), [0, 1, 2, 3, 4])
+        self.assertEqual(calls, [2, 5, 5])
+        self.assertEqual(list(count(5)), [0, 1, 2, 3, 4])
+        self.assertEqual(calls, [2, 5, 5, 5])
+
+    def test_maxbytes(self):
+        calls = []
+
+        @decorators.memoize(maxbytes=10000)
+        def blocks(n, size=1000):
+            calls.append(n)
+            for i in range(n):
+                yield str(i) * size
+
+        for n in (3, 4, 5):
+            self.assertEqual(len(list(blocks(n))), n)
+        # the recorded items count against the budget, so the oldest recordings are evicted
+        info = blocks.cache_info()
+        self.assertTrue(info.currbytes <= 10000 and info.currbytes >= 5000, info)
+        self.assertEqual((info.currsize, info.evictions), (1, 2))
+        self.assertEqual(list(blocks(5)), [str(i) * 1000 for i in range(5)])
+        self.assertEqual(calls, [3, 4, 5])
+        # a generator that outgrows the whole budget is still consumed in full, but isn't cached
+        big = blocks(20)
+        replay = blocks(20)
+        self.assertEqual(len(list(big)), 20)
+        self.assertEqual(list(replay), [str(i) * 1000 for i in range(20)])
+        self.assertTrue(blocks.cache_info().currbytes <= 10000)
+        self.assertEqual(len(list(blocks(20))), 20)
+        self.assertEqual(calls, [3, 4, 5, 20, 20, 20])
+
+    def test_threaded_consumers(self):
+        @decorators.memoize
+        def squares(n):
+            for i in range(n):
+                time.sleep(0.0001)
+                yield i * i
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(list(squares(200)))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[i * i for i in range(200)]] * 4)
+        self.assertEqual(squares.cache_info().misses, 1)
+
+
+class MemoizeBatchTest(TestCase):
+
+    def test_array_rows(self):
+        import numpy as np
+        batches = []
+
+        @decorators.memoize_batch(key=decorators.array_key, collate=np.array)
+        def norms(rows):
+            batches.append(len(rows))
+            return np.sqrt((rows ** 2).sum(axis=1))
+
+        X = np.arange(12.).reshape(4, 3)
+        expected = np.sqrt((X ** 2).sum(axis=1))
+        self.assertTrue(np.allclose(norms(X[:2]), expected[:2]))
+        self.assertTrue(np.allclose(norms(X[::-1]), expected[::-1]))
+        self.assertEqual(batches, [2, 2])
+
+    def test_non_buffer_dtypes(self):
+        import numpy as np
+        dates = np.array(['2014-01-01', '2014-06-01'], dtype='datetime64[D]')
+        for arr in (dates, dates - dates[0], np.datetime64('2014-01-01'), np.zeros((0, 2), dtype='m8[s]')):
+            arr = np.asarray(arr)
+            self.assertEqual(decorators.array_digest(arr), decorators.array_digest(arr.copy()))
+        # non-contiguous arrays are copied before they are hashed
+        self.assertNotEqual(decorators.array_digest(dates), decorators.array_digest(dates[::-1]))
+        self.assertNotEqual(decorators.array_digest(dates.reshape(2, 1).T), decorators.array_digest(dates.reshape(1, 2)))
+        self.assertNotEqual(decorators.array_digest(dates), decorators.array_digest(dates.astype('datetime64[s]')))
+
+    def test_result_count_mismatch(self):
+        @decorators.memoize_batch
+        def broken(items):
+            return items[1:]
+        self.assertRaises(ValueError, broken, [1, 2, 3])
+        self.assertEqual(len(broken.cache), 0)
+
+
+class Scaler(object):
+    def __init__(self, factor):
+        self.factor = factor
+
+    @decorators.memoize_method
+    def scaled(self, x):
+        return self.factor * x
+
+    def _twice(self, x):
+        return 2 * self.factor * x
+    # the attribute has a different name than the function
+    twice = decorators.memoize_method(_twice)
+
+
+class MemoizeMethodTest(TestCase):
+
+    def test_copy_and_pickle(self):
+        import copy
+        import pickle
+        a = Scaler(2)
+        self.assertEqual(a.scaled(2), 4)
+        b = copy.copy(a)
+        b.factor = 200
+        self.assertEqual(b.scaled(2), 400)
+        self.assertEqual(a.scaled(2), 4)
+        c = copy.deepcopy(a)
+        c.factor = 3
+        self.assertEqual(c.scaled(2), 6)
+        d = pickle.loads(pickle.dumps(a, 2))
+        self.assertEqual((d.factor, d.scaled(2)), (2, 4))
+        self.assertEqual(d.scaled.cache_info().misses, 1)
+
+    def test_renamed(self):
+        a = Scaler(2)
+        self.assertTrue(a.twice is a.twice)
+        self.assertEqual((a.twice(1), a.twice(1), a._twice(1)), (4, 4, 4))
+        self.assertEqual(a.twice.cache_info().hits, 1)
+
+    def test_cache_freed_with_instance(self):
+        class Counter(object):
+            calls = 0
+
+            @decorators.memoize_method
+            def count(self, x):
+                Counter.calls += 1
+                return x
+
+        class SlottedCounter(object):
+            __slots__ = ('__weakref__',)
+            count = Counter.__dict__['count']
+
+        for cls in (Counter, SlottedCounter):
+            obj = cls()
+            obj.count(1)
+            obj.count(1)
+            cache_ref = weakref.ref(obj.count)
+            obj_ref = weakref.ref(obj)
+            del obj
+            gc.collect()
+            self.assertTrue(obj_ref() is None)
+            self.assertTrue(cache_ref() is None)
+        self.assertEqual(Counter.calls, 2)
+
+
+class LogWithTest(TestCase):
+
+    def test_no_formatting_when_disabled(self):
+        formatted = []
+
+        class Message(str):
+            def format(self, *args):
+                formatted.append(args)
+                return str.format(self, *args)
+
+        class counted_log_with(decorators.log_with):
+            ENTRY_MESSAGE = Message('Entering {}')
+            EXIT_MESSAGE = Message('Exiting {}')
+
+        logger = logging.getLogger('pug.tests.test_decorators.quiet')
+        logger.setLevel(logging.WARNING)
+
+        @counted_log_with(logger=logger)
+        def add(x, y):
+            return x + y
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(formatted, [])
+        logger.setLevel(logging.INFO)
+        add(1, 2)
+        self.assertEqual(formatted, [('add',), ('add',)])
+
+    def test_timed_methods_with_the_same_name(self):
+        class Order(object):
+            @decorators.log_with(timing=True)
+            def save(self):
+                pass
+
+        class Invoice(object):
+            @decorators.log_with(timing=True)
+            def save(self):
+                pass
+
+        Order().save()
+        Invoice().save()
+        Invoice().save()
+        self.assertNotEqual(Order.save.latency_name, Invoice.save.latency_name)
+        self.assertEqual(Order.save.latency_summary()['wall']['count'], 1)
+        self.assertEqual(Invoice.save.latency_summary()['wall']['count'], 2)
+        self.assertEqual(decorators.latency_summary()[Invoice.save.latency_name]['wall']['count'], 2)
+
+    def test_queue_overflow(self):
+        records = []
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                time.sleep(0.01)
+                records.append(record.getMessage())
+
+        for overflow, expected_dropped in (('drop', True), ('block', False)):
+            del records[:]
+            logger = logging.getLogger('pug.tests.test_decorators.' + overflow)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(SlowHandler())
+            handler = decorators.queue_log_handlers(logger, maxsize=2, overflow=overflow)
+
+            @decorators.log_with(logger=logger, queued=True)
+            def noop():
+                pass
+
+            for i in range(5):
+                noop()
+            handler.listener.stop()
+            self.assertEqual(bool(handler.dropped), expected_dropped)
+            self.assertEqual(len(records) + handler.dropped, 10)
+
+    def test_logging_after_stop(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger('pug.tests.test_decorators.stopped')
+        logger.propagate = False
+        original = ListHandler()
+        logger.addHandler(original)
+        handler = decorators.queue_log_handlers(logger, maxsize=1, overflow='block')
+        logger.warn('queued')
+        handler.listener.stop()
+        self.assertEqual(logger.handlers, [original])
+        # with nothing draining the queue, a full queue would block forever
+        for i in range(3):
+            logger.warn('direct %s', i)
+        self.assertEqual(records, ['queued', 'direct 0', 'direct 1', 'direct 2'])
+        self.assertFalse(decorators.queue_log_handlers(logger) is handler)
+        logger.handlers[0].listener.stop()
+
+    def test_queued_without_handlers(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger('pug.tests.test_decorators.unconfigured')
+        logger.propagate = False
+        self.assertEqual(decorators.queue_log_handlers(logger), None)
+
+        @decorators.log_with(logger=logger, queued=True)
+        def noop():
+            pass
+
+        self.assertEqual(logger.handlers, [])
+        # handlers configured later emit the records directly
+        logger.setLevel(logging.INFO)
+        logger.addHandler(ListHandler())
+        noop()
+        self.assertEqual(records, ['Entering noop', 'Exiting noop'])
+
+
+class TraceTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_exporters(self):
+        jsonl_path = os.path.join(self.tempdir, 'spans.jsonl')
+        chrome_path = os.path.join(self.tempdir, 'trace.json')
+        jsonl = decorators.JsonLinesSpanExporter(jsonl_path, batch_size=2)
+        chrome = decorators.ChromeTraceSpanExporter(chrome_path, batch_size=2)
+
+        @decorators.trace(chrome)
+        def fail(x):
+            raise ValueError(x)
+
+        @decorators.trace(jsonl)
+        def parent(x):
+            try:
+                fail(x)
+            except ValueError:
+                pass
+            return x
+
+        for i in range(3):
+            parent(i)
+        # one span is still waiting for a full batch
+        self.assertEqual(len(open(jsonl_path).readlines()), 2)
+        jsonl.flush()
+        spans = [json.loads(line) for line in open(jsonl_path)]
+        self.assertEqual([span['args'] for span in spans], ['(0)', '(1)', '(2)'])
+        self.assertTrue(all(span['parent_id'] is None and span['error'] is None for span in spans))
+        chrome.close()
+        events = json.load(open(chrome_path))
+        self.assertEqual([event['args']['parent_id'] for event in events], [span['id'] for span in spans])
+        self.assertEqual(events[0]['args']['error'], 'ValueError: 0')
+        self.assertEqual(events[0]['ph'], 'X')
+
+
+class SqliteCacheTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'memoize.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_maxbytes_eviction(self):
+        @decorators.memoize(backend=decorators.SqliteCache(self.path, maxbytes=2000))
+        def padded(x):
+            return str(x) * 300
+
+        for i in range(10):
+            padded(i)
+        connection = padded.cache.connection
+        entries, nbytes = connection.execute('SELECT entries, bytes FROM memoize_totals').fetchone()
+        self.assertTrue(0 < entries < 10)
+        self.assertEqual((entries, nbytes), connection.execute('SELECT COUNT(*), SUM(size) FROM memoize').fetchone())
+        self.assertTrue(nbytes <= 2000)
+        padded(9)
+        self.assertEqual(padded.cache_info().hits, 1)
+        padded(0)
+        self.assertEqual(padded.cache_info().misses, 11)
+
+    def test_code_change_invalidates(self):
+        def f(x):
+            return x + 1
+        cached = decorators.memoize(f, backend=decorators.SqliteCache(self.path))
+        cached(1)
+
+        def f(x):
+            return x + 2
+        edited = decorators.memoize(f, backend=decorators.SqliteCache(self.path))
+        self.assertEqual(edited(1), 3)
+        self.assertEqual(edited.cache_info().misses, 1)
+        salted = decorators.memoize(cached.func, backend=decorators.SqliteCache(self.path, salt=1))
+        self.assertEqual(len(salted.cache), 0)
+
+    def test_identity_keys_bypass_the_file(self):
+        class Box(object):
+            def __init__(self, v):
+                self.v = v
+
+        @decorators.memoize(backend=decorators.SqliteCache(self.path))
+        def unbox(b):
+            return b.v
+        # each Box may reuse the address (and default repr) of the one before it
+        self.assertEqual([unbox(Box(i)) for i in range(5)], range(5))
+        self.assertEqual(len(unbox.cache), 0)
+
+    def test_set_keys_are_canonical(self):
+        self.assertEqual(decorators.SqliteCache.serialize_key((frozenset(['x', 'y', 'z']),)),
+                         decorators.SqliteCache.serialize_key((frozenset(['z', 'y', 'x']),)))
+        self.assertEqual(decorators.SqliteCache.serialize_key((lambda: 1,)), None)
+
+    def test_hits_touch_sparingly(self):
+        @decorators.memoize(backend=decorators.SqliteCache(self.path, touch_interval=3600))
+        def double(x):
+            return 2 * x
+        double(1)
+        connection = double.cache.connection
+        accessed = connection.execute('SELECT accessed FROM memoize').fetchone()[0]
+        self.assertEqual((double(1), double(1)), (2, 2))
+        self.assertEqual(connection.execute('SELECT accessed FROM memoize').fetchone()[0], accessed)
+        double.cache.touch_interval = 0
+        double(1)
+        self.assertTrue(connection.execute('SELECT accessed FROM memoize').fetchone()[0] > accessed)
+
+    def test_concurrent_writers(self):
+        backend = decorators.SqliteCache(self.path, maxsize=50)
+
+        @decorators.memoize(backend=backend)
+        def negate(x):
+            return -x
+
+        def work(offset):
+            for i in range(40):
+                negate(offset + i)
+        threads = [threading.Thread(target=work, args=(100 * t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(negate.cache), 50)
+        self.assertEqual(negate(339), -339)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+"""
+Uses the unittest module to test the Django model decorators in pug.decorators against an in-memory SQLite database.
+"""
+
+import atexit
+import os
+import tempfile
+from unittest import TestCase, main
+
+from django.conf import settings
+# outside of a Django project the settings must be configured before the models are defined (pug.decorators doesn't touch them)
+if not settings.configured:
+    settings.configure()
+if not settings.DATABASES:
+    settings.DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+# worker processes can't share an in-memory database
+PARALLEL_DB = tempfile.mkstemp(suffix='.sqlite3')[1]
+atexit.register(os.remove, PARALLEL_DB)
+settings.DATABASES['parallel'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': PARALLEL_DB}
+# a primary and 2 replicas for DbAliasRouter (in-memory, so the replicas aren't really replicated)
+for alias in ('routed', 'routed_replica1', 'routed_replica2'):
+    settings.DATABASES[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+
+from django.core.management.color import no_style
+from django.db import close_old_connections, connection, connections, models, router
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext
+
+from nlp.db import representation
+
+from pug import decorators
+
+
+@decorators.updatable
+class Word(models.Model):
+    text = models.CharField(max_length=64)
+    length = models.IntegerField(null=True)
+    upper = models.CharField(max_length=64, null=True)
+    note = models.CharField(max_length=64, blank=True, default='')
+
+    _depends_on = {'length': ('text',), 'upper': ('text',)}
+
+    class Meta:
+        app_label = 'pug_tests'
+
+    def _get_length(self):
+        return len(self.text)
+    _length = property(_get_length)
+
+    def _get_upper(self):
+        return self.text.upper()
+    _upper = property(_get_upper)
+
+
+@decorators.represent
+class Author(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+
+    class Meta:
+        app_label = 'pug_tests'
+
+
+@decorators.linkable_rels
+class Book(models.Model):
+    title = models.CharField(max_length=64)
+    author_name = models.CharField(max_length=64)
+    author = models.ForeignKey(Author, null=True)
+
+    _natural_keys = {'author': 'name'}
+
+    class Meta:
+        app_label = 'pug_tests'
+
+    def _get_author(self):
+        return Author.objects.get(name=self.author_name)
+    _author = property(_get_author)
+
+    @property
+    def _key_author(self):
+        return self.author_name
+
+
+@decorators.represent
+@decorators.updatable
+@decorators.audit
+class Page(models.Model):
+    text = models.TextField()
+    words = models.IntegerField(null=True)
+
+    _repr_fields = ('text', 'words', 'missing')
+    _depends_on = {'words': ('text',)}
+
+    class Meta:
+        app_label = 'pug_tests'
+
+    @decorators.memoize_audited
+    def _get_words(self):
+        return len(self.text.split())
+    _words = property(_get_words)
+
+
+@decorators.dbname('routed')
+class Note(models.Model):
+    text = models.CharField(max_length=64)
+
+    class Meta:
+        app_label = 'pug_tests'
+
+
+@decorators.dbname('routed')
+class RoutedAuthor(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+
+    class Meta:
+        app_label = 'pug_tests'
+
+
+@decorators.dbname('routed')
+@decorators.linkable_rels
+class RoutedBook(models.Model):
+    author_name = models.CharField(max_length=64)
+    author = models.ForeignKey(RoutedAuthor, null=True)
+
+    _natural_keys = {'author': 'name'}
+
+    class Meta:
+        app_label = 'pug_tests'
+
+    def _get_author(self):
+        return RoutedAuthor.objects.get(name=self.author_name)
+    _author = property(_get_author)
+
+    @property
+    def _key_author(self):
+        return self.author_name
+
+
+@decorators.dbname('routed')
+@decorators.updatable
+class RoutedWord(models.Model):
+    text = models.CharField(max_length=64)
+    length = models.IntegerField(null=True)
+
+    class Meta:
+        app_label = 'pug_tests'
+
+    def _get_length(self):
+        return len(self.text)
+    _length = property(_get_length)
+
+
+def create_tables(*models, **kwargs):
+    connection = connections[kwargs.get('using', 'default')]
+    cursor = connection.cursor()
+    for model in models:
+        sql, references = connection.creation.sql_create_model(model, no_style())
+        for statement in sql:
+            cursor.execute(statement)
+
+
+def update_queries(queries):
+    return [q['sql'] for q in queries if 'UPDATE ' in q['sql']]
+
+
+create_tables(Word, Author, Book, Page)
+create_tables(Word, using='parallel')
+for alias in ('routed', 'routed_replica1', 'routed_replica2'):
+    create_tables(Note, RoutedAuthor, RoutedBook, RoutedWord, using=alias)
+
+
+class BulkUpdateTest(TestCase):
+
+    def setUp(self):
+        Word.objects.all().delete()
+        for text in ('a', 'bb', 'ccc', 'dddd', 'eeeee'):
+            Word.objects.create(text=text)
+        Word.objects.filter(text='bb').update(length=2)
+
+    def test_bulk_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = Word._bulk_update(batch_size=2)
+        self.assertEqual(rows, 5)
+        # 1 SELECT plus one UPDATE for each of the 3 chunks
+        self.assertEqual(len(update_queries(queries)), 3)
+        self.assertEqual(list(Word.objects.order_by('text').values_list('text', 'length', 'upper')),
+                         [(t, len(t), t.upper()) for t in ('a', 'bb', 'ccc', 'dddd', 'eeeee')])
+        # nothing has changed, so nothing is written
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Word._bulk_update(overwrite=True), 0)
+        self.assertFalse(update_queries(queries))
+
+    def test_only_changed_columns(self):
+        Word.objects.update(upper='X')
+        with CaptureQueriesContext(connection) as queries:
+            Word._bulk_update(Word.objects.filter(text__in=['a', 'bb']))
+        updates = update_queries(queries)
+        self.assertEqual(len(updates), 1)
+        self.assertFalse('"upper"' in updates[0])
+        self.assertEqual(list(Word.objects.order_by('text').values_list('length', flat=True)), [1, 2, None, None, None])
+
+
+class FieldPlanTest(TestCase):
+
+    def test_plan_is_compiled_once(self):
+        plan = decorators._field_plan(Word)
+        self.assertEqual([f.name for f in plan], ['length', 'upper'])
+        self.assertTrue(decorators._field_plan(Word) is plan)
+        self.assertEqual([(f.name, f.attname, f.related) for f in decorators._field_plan(Book)], [('author', 'author_id', True)])
+        self.assertFalse(decorators._field_plan(Book, related=False))
+
+    def test_update(self):
+        word = Word(text='abc')
+        self.assertEqual(word._update(), ['length', 'upper'])
+        self.assertEqual((word.length, word.upper), (3, 'ABC'))
+        word.text = 'abcd'
+        self.assertEqual(word._update(), [])
+        self.assertEqual(word._update(fields=['length'], overwrite=True), ['length'])
+        self.assertEqual((word.length, word.upper), (4, 'ABC'))
+
+    def test_link_rels(self):
+        Author.objects.get_or_create(name='plan')
+        book = Book(title='plans', author_name='plan')
+        with CaptureQueriesContext(connection) as queries:
+            book._link_rels()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(book.author.name, 'plan')
+
+
+class DirtyTrackingTest(TestCase):
+
+    def setUp(self):
+        Word.objects.all().delete()
+        Word.objects.create(text='abc', length=3, upper='ABC')
+
+    def test_clean_instance(self):
+        word = Word.objects.get(text='abc')
+        self.assertEqual(word._dirty_fields(), set())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(word._update(save=True, update_fields=True), [])
+        self.assertEqual(len(queries), 0)
+
+    def test_overwrite(self):
+        Word.objects.update(length=999)
+        word = Word.objects.get(text='abc')
+        self.assertEqual(word._update(overwrite=True), ['length', 'upper'])
+        self.assertEqual(word.length, 3)
+
+    def test_dirty_source(self):
+        word = Word.objects.get(text='abc')
+        word.text = 'abcd'
+        self.assertEqual(word._dirty_fields(), set(['text']))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(word._update(save=True), ['length', 'upper'])
+        updates = update_queries(queries)
+        self.assertEqual(len(updates), 1)
+        self.assertTrue('"length"' in updates[0] and '"upper"' in updates[0])
+        self.assertEqual(word._dirty_fields(), set())
+        self.assertEqual(list(Word.objects.values_list('text', 'length', 'upper')), [('abcd', 4, 'ABCD')])
+
+    def test_only_changed_fields_saved(self):
+        Word.objects.update(upper='WRONG')
+        word = Word.objects.get(text='abc')
+        word.text = 'xyz'
+        with CaptureQueriesContext(connection) as queries:
+            word._update(save=True, update_fields=True)
+        updates = update_queries(queries)
+        # the length didn't change so it isn't written
+        self.assertFalse('"length"' in updates[0] or '"note"' in updates[0])
+        self.assertEqual(list(Word.objects.values_list('text', 'length', 'upper')), [('xyz', 3, 'XYZ')])
+
+    def test_other_edits_saved(self):
+        word = Word.objects.get(text='abc')
+        word.note = 'user edit'
+        word._update(save=True)
+        self.assertEqual(Word.objects.get(pk=word.pk).note, 'user edit')
+        word.note = 'listed edit'
+        word.text = 'abcd'
+        word._update(save=True, update_fields=['note'])
+        self.assertEqual(list(Word.objects.values_list('text', 'length', 'note')), [('abcd', 4, 'listed edit')])
+
+    def test_auto_now(self):
+        Page.objects.create(text='one')
+        page = Page.objects.get(text='one')
+        updated = page.updated
+        page.text = 'one two'
+        page._update(save=True, update_fields=True)
+        self.assertTrue(Page.objects.get(pk=page.pk).updated > updated)
+
+
+class ParallelUpdateTest(TestCase):
+
+    def setUp(self):
+        Word.objects.using('parallel').all().delete()
+        Word.objects.using('parallel').bulk_create([Word(text='w' * (i % 7 + 1)) for i in range(25)])
+
+    def test_processes(self):
+        progress = decorators.parallel_update(Word, using='parallel', processes=2, chunk_size=10)
+        self.assertEqual(progress.chunks, 3)
+        self.assertEqual((progress.rows, progress.updated, progress.failed), (25, 25, []))
+        for text, length, upper in Word.objects.using('parallel').values_list('text', 'length', 'upper'):
+            self.assertEqual((length, upper), (len(text), text.upper()))
+
+    def test_queryset(self):
+        progress = decorators.parallel_update(Word, Word.objects.filter(text='w'), using='parallel', processes=2, chunk_size=10)
+        self.assertEqual((progress.rows, progress.updated), (4, 4))
+        self.assertEqual(Word.objects.using('parallel').filter(length__isnull=False).count(), 4)
+
+    def flaky_update(self, failures, **kwargs):
+        bulk_update, attempts = decorators._bulk_update, []
+
+        def flaky_bulk_update(model, queryset=None, **kwargs):
+            attempts.append(queryset)
+            if len(attempts) <= failures:
+                raise RuntimeError('database is locked')
+            return bulk_update(model, queryset=queryset, **kwargs)
+        decorators._bulk_update = flaky_bulk_update
+        try:
+            return decorators.parallel_update(Word, using='parallel', processes=1, chunk_size=10, **kwargs), len(attempts)
+        finally:
+            decorators._bulk_update = bulk_update
+
+    def test_retries(self):
+        progress, attempts = self.flaky_update(2, retries=1)
+        self.assertEqual(attempts, 5)
+        self.assertEqual((progress.rows, progress.updated, progress.failed), (25, 25, []))
+
+    def test_failed_chunks(self):
+        progress, attempts = self.flaky_update(5, retries=1)
+        self.assertEqual(attempts, 6)
+        self.assertEqual(progress.updated, 5)
+        self.assertEqual([error for lo, hi, error in progress.failed], ['RuntimeError: database is locked'] * 2)
+
+
+class BulkIngestTest(TestCase):
+
+    def setUp(self):
+        Word.objects.all().delete()
+
+    def test_csv(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('text,length,comment\n')
+            for i in range(10):
+                f.write('{},{},ignored\n'.format('w' * (i + 1), 99 if i == 0 else ''))
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(Word._bulk_ingest(path, batch_size=4), 10)
+        finally:
+            os.remove(path)
+        self.assertEqual(len([q for q in queries if 'INSERT ' in q['sql']]), 3)
+        words = list(Word.objects.order_by('length').values_list('text', 'length', 'upper'))
+        self.assertEqual(words[0], ('ww', 2, 'WW'))
+        # the length given in the file is kept
+        self.assertEqual(words[-1], ('w', 99, 'W'))
+
+    def test_generator(self):
+        rows = ({'word': text} for text in ('x', 'yy', 'zzz'))
+        self.assertEqual(decorators.bulk_ingest(Word, rows, columns={'word': 'text'}), 3)
+        self.assertEqual(list(Word.objects.order_by('text').values_list('text', 'length', 'upper')),
+                         [('x', 1, 'X'), ('yy', 2, 'YY'), ('zzz', 3, 'ZZZ')])
+
+
+class MemoizeAuditedTest(TestCase):
+
+    def setUp(self):
+        Page.objects.all().delete()
+        Page._get_words.cache_clear()
+        for i in range(5):
+            Page.objects.create(text='word ' * i)
+
+    def test_audit_fields(self):
+        self.assertEqual([f.name for f in Page._meta.fields], ['id', 'text', 'words', 'updated', 'created'])
+        page = Page.objects.all()[0]
+        self.assertTrue(page.updated and page.created)
+
+    def test_cached_until_saved(self):
+        page = Page.objects.get(text='word ')
+        self.assertEqual((page._words, page._words), (1, 1))
+        self.assertEqual(Page._get_words.cache_info().misses, 1)
+        # another instance of the same row shares the cached value
+        self.assertEqual(Page.objects.get(pk=page.pk)._words, 1)
+        self.assertEqual(Page._get_words.cache_info().hits, 2)
+        page.text = 'two words'
+        page.save()
+        self.assertEqual(page._words, 2)
+        self.assertEqual(Page._get_words.cache_info().misses, 2)
+        self.assertEqual(Page._get_words.cache_info().currsize, 1)
+
+    def test_edited_before_save(self):
+        page = Page.objects.get(text='word ')
+        self.assertEqual(page._words, 1)
+        page.text = 'two words'
+        self.assertEqual(page._words, 2)
+        # a clean instance of the same row still gets the cached value for the saved text
+        self.assertEqual(Page.objects.get(pk=page.pk)._words, 1)
+        self.assertEqual(page._update(save=True), ['words'])
+        self.assertEqual(Page.objects.get(pk=page.pk).words, 2)
+        self.assertEqual(Page.objects.get(pk=page.pk)._words, 2)
+
+    def test_unsaved(self):
+        page = Page(text='not saved yet')
+        self.assertEqual(page._words, 3)
+        self.assertEqual(Page._get_words.cache_info().currsize, 0)
+
+    def test_prefetch(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Page._get_words.prefetch(Page.objects.all()), 5)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(Page._get_words.prefetch(Page.objects.all()), 0)
+        self.assertEqual(Page._bulk_update(), 5)
+        self.assertEqual(Page._get_words.cache_info().misses, 5)
+        self.assertEqual(list(Page.objects.order_by('words').values_list('words', flat=True)), range(5))
+
+
+class RepresentTest(TestCase):
+
+    def test_same_as_representation(self):
+        Author.objects.get_or_create(name='represented')
+        Page.objects.create(text='two words')
+        objs = [Author.objects.get(name='represented'), Author(name=u'unsaved \xe9'), Author(),
+                Page.objects.get(text='two words'), Page(text='', words=0)]
+        for obj in objs:
+            self.assertEqual(unicode(obj), representation(obj))
+        # the reverse relation added by Book is one of Author's default fields
+        self.assertTrue('book' in Author._meta.get_all_field_names()[:3])
+        self.assertEqual(unicode(objs[1]), "Author('', '', '', u'unsaved \\xe9')")
+
+
+class DbAliasRouterTest(TestCase):
+
+    def setUp(self):
+        self.router = decorators.DbAliasRouter({'routed': ['routed_replica1', 'routed_replica2']})
+        router.routers.insert(0, self.router)
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        for alias in ('routed', 'routed_replica1', 'routed_replica2'):
+            Note.objects.using(alias).all().delete()
+
+    def test_routing(self):
+        self.assertEqual(Note._db_alias, 'routed')
+        note = Note.objects.create(text='written to the primary')
+        self.assertEqual(note._state.db, 'routed')
+        self.assertEqual(Note.objects.using('routed').count(), 1)
+        Note.objects.using('routed_replica1').create(text='replicated')
+        # reads alternate between the replicas, neither of which has the new note yet
+        self.assertEqual([Note.objects.count() for i in range(4)], [1, 0, 1, 0])
+        self.assertEqual(router.db_for_read(Word), 'default')
+        self.assertEqual(router.db_for_write(Note), 'routed')
+
+    def test_allow(self):
+        primary, replica = Note(), Note()
+        primary._state.db, replica._state.db = 'routed', 'routed_replica2'
+        self.assertTrue(self.router.allow_relation(primary, replica))
+        self.assertEqual(self.router.allow_relation(Word(), Word()), None)
+        self.assertTrue(self.router.allow_syncdb('routed', Note))
+        self.assertFalse(self.router.allow_syncdb('routed_replica1', Note))
+        self.assertFalse(self.router.allow_syncdb('routed_replica1', Word))
+
+    def test_bulk_ingest(self):
+        self.assertEqual(decorators.bulk_ingest(Note, [{'text': 'routed'}, {'text': 'rows'}]), 2)
+        self.assertEqual(Note.objects.using('routed').count(), 2)
+
+
+class RoutedBulkLinkRelsTest(TestCase):
+
+    def setUp(self):
+        self.router = decorators.DbAliasRouter({'routed': ['routed_replica1']})
+        router.routers.insert(0, self.router)
+        for alias in ('routed', 'routed_replica1'):
+            RoutedAuthor.objects.using(alias).create(pk=1, name='routed author')
+        RoutedBook.objects.using('routed').create(pk=1, author_name='routed author')
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        for alias in ('routed', 'routed_replica1'):
+            RoutedBook.objects.using(alias).all().delete()
+            RoutedAuthor.objects.using(alias).all().delete()
+
+    def test_routed_instances(self):
+        books = list(RoutedBook.objects.using('routed').all())
+        with CaptureQueriesContext(connections['routed_replica1']) as replica_queries:
+            with CaptureQueriesContext(connections['routed']) as primary_queries:
+                self.assertEqual(RoutedBook._bulk_link_rels(books, save=True), 1)
+        self.assertEqual(len(replica_queries), 1)
+        self.assertEqual(len(update_queries(primary_queries)), 1)
+        self.assertEqual(RoutedBook.objects.using('routed').get(pk=1).author_id, 1)
+
+
+class RoutedBulkUpdateTest(TestCase):
+
+    def setUp(self):
+        self.router = decorators.DbAliasRouter({'routed': ['routed_replica1']})
+        router.routers.insert(0, self.router)
+        for alias in ('routed', 'routed_replica1'):
+            RoutedWord.objects.using(alias).create(pk=1, text='abc')
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        for alias in ('routed', 'routed_replica1'):
+            RoutedWord.objects.using(alias).all().delete()
+
+    def lengths(self):
+        return [list(RoutedWord.objects.using(alias).values_list('length', flat=True)) for alias in ('routed', 'routed_replica1')]
+
+    def test_bulk_update(self):
+        with CaptureQueriesContext(connections['routed']) as primary_queries:
+            self.assertEqual(RoutedWord._bulk_update(), 1)
+        self.assertEqual(len(update_queries(primary_queries)), 1)
+        self.assertEqual(self.lengths(), [[3], [None]])
+
+    def test_parallel_update(self):
+        self.assertEqual(decorators.parallel_update(RoutedWord, processes=1).updated, 1)
+        self.assertEqual(self.lengths(), [[3], [None]])
+
+
+class PersistentConnectionsTest(TestCase):
+
+    def test_reused_between_chunks(self):
+        created = []
+
+        def count(sender, connection, **kwargs):
+            created.append(connection.alias)
+        connection_created.connect(count)
+        connections['parallel'].close()
+        try:
+            with decorators.persistent_connections('parallel') as opened:
+                for chunk in range(3):
+                    Word.objects.using('parallel').count()
+                    close_old_connections()
+                self.assertTrue(opened['parallel'].connection is not None)
+            self.assertTrue(connections['parallel'].connection is None)
+            self.assertEqual(created, ['parallel'])
+            # without persistent_connections (and CONN_MAX_AGE = 0) a connection is opened for every chunk
+            for chunk in range(3):
+                Word.objects.using('parallel').count()
+                close_old_connections()
+            self.assertEqual(created, ['parallel'] * 4)
+        finally:
+            connection_created.disconnect(count)
+
+
+class BulkLinkRelsTest(TestCase):
+
+    def setUp(self):
+        Book.objects.all().delete()
+        Author.objects.all().delete()
+        for i in range(5):
+            Author.objects.create(name='author{}'.format(i))
+
+    def test_queries_per_chunk(self):
+        for i in range(50):
+            Book.objects.create(title='book{}'.format(i), author_name='author{}'.format(i % 6))
+        with CaptureQueriesContext(connection) as queries:
+            linked = Book._bulk_link_rels(batch_size=20, save=True)
+        # author5 doesn't exist so those books stay unlinked
+        self.assertEqual(linked, 50 - 8)
+        author_queries = [q for q in queries if 'FROM "pug_tests_author"' in q['sql']]
+        self.assertEqual(len(author_queries), 3)
+        self.assertEqual(len(update_queries(queries)), 3)
+        for book in Book.objects.select_related('author'):
+            if book.author_name == 'author5':
+                self.assertEqual(book.author, None)
+            else:
+                self.assertEqual(book.author.name, book.author_name)
+
+    def test_unsaved_objects(self):
+        books = [Book(title='book{}'.format(i), author_name='author{}'.format(i % 2)) for i in range(10)]
+        with CaptureQueriesContext(connection) as queries:
+            Book._bulk_link_rels(books)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(set(book.author.name for book in books), set(['author0', 'author1']))
+
+
+if __name__ == '__main__':
+    main()